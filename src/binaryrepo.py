@@ -1,24 +1,36 @@
+import bz2
+import hashlib
 import io
+import lzma
 import os
-import requests
+import pickle
+import shutil
+import sys
 import tarfile
+import tempfile
 import urllib
-
-from email.utils import formatdate
+import zlib
 
 from config import Config
+from progress import Progress
 from repo import BinPkg
 from repo import PkgDep
 from repo import PkgVersion
 from repo import SrcPkg
 from repo import Repo
+from repo import RepoChanges
 from utils import slugify
 
 class BinaryRepo(Repo):
+	# Bump whenever the pickled form of the package classes changes
+	_snapshot_version = 3
+
 	def __init__(self, name, url):
 		Repo.__init__(self, name)
+		self._stamp = None
 		self.init_paths(name, url)
 		self.read_packages()
+		self.index_sources()
 
 	def init_paths(self, name, url):
 		self._url_db = "{0}/{1}.db".format(url, name)
@@ -30,34 +42,47 @@ class BinaryRepo(Repo):
 
 		self._cache_db = os.path.join(cache_dir, "db")
 		self._cache_src = os.path.join(cache_dir, "src")
-
-	def download(self, url, filename):
-		headers = {}
-		if os.path.exists(filename):
-			mod = os.path.getmtime(filename)
-			headers["If-Modified-Since"] = formatdate(timeval=mod, usegmt=True)
-
-		req = requests.get(url, headers=headers)
-
-		if req.status_code == 304:
-			return False
-
-		if req.status_code != 200:
-			raise Exception()
-
-		print("Downloading {0}".format(url))
-
-		with open(filename, "wb") as file:
-			for chunk in req.iter_content(4096):
-				file.write(chunk)
-
-		return True
-
-	def refresh(self):
-		self.download(self._url_src, self._cache_src)
-		self.download(self._url_db, self._cache_db)
-
-		self.read_packages()
+		self._cache_src_dir = os.path.join(cache_dir, "src.d")
+		self._cache_snapshot = os.path.join(cache_dir, "db.snapshot")
+
+	@property
+	def label(self):
+		return "{0} (binary)".format(self._name)
+
+	def downloads(self):
+		return [ (self._url_src, self._cache_src), (self._url_db, self._cache_db) ]
+
+	def refresh(self, progress=None):
+		# The files named by downloads() are fetched beforehand, alongside
+		# those of every other repo, by the Downloader
+		old = self._pkgs
+		with Progress.track(progress, self.label, "parse"):
+			self.read_packages()
+			self.index_sources()
+			return self.diff_packages(old)
+
+	def diff_packages(self, old):
+		# Compare freshly read packages against those we had before. Any
+		# which are unchanged keep their old objects, so that whatever
+		# refers to them needn't be updated.
+		if self._pkgs is old:
+			return RepoChanges()
+
+		added = []
+		changed = []
+
+		for name, spkg in self._pkgs.items():
+			prev = old.get(name, None)
+			if prev is None:
+				added.append(name)
+			elif prev.signature() != spkg.signature():
+				changed.append(name)
+			else:
+				self._pkgs[name] = prev
+
+		removed = [ name for name in old if name not in self._pkgs ]
+
+		return RepoChanges(added=added, removed=removed, changed=changed)
 
 	def read_packages(self):
 		print("Reading {0}...".format(self._cache_db), end="", flush=True)
@@ -65,72 +90,341 @@ class BinaryRepo(Repo):
 		if not os.path.exists(self._cache_db):
 			print(" not found!")
 			return False
+
+		stamp = BinaryRepo.file_stamp(self._cache_db)
+		if stamp == self._stamp:
+			print(" unchanged")
+			return True
+
+		if self.load_snapshot(stamp):
+			self._stamp = stamp
+			print(" done (snapshot)")
+			return True
+
 		if not tarfile.is_tarfile(self._cache_db):
 			print(" not a tar!")
 			return False
 
-		tar = tarfile.open(self._cache_db)
-		pkg_info = {}
 		self._pkgs = {}
 
-		for info in tar.getmembers():
-			if not info.isfile():
-				continue
+		# Stream through the DB in a single pass. Each package's files are
+		# stored together, so a package is complete as soon as a member
+		# from another package is reached. Older DBs split each package
+		# into desc & depends, newer ones keep everything in desc.
+		current = None
+		fields = {}
 
-			( binpkg_name, file_name ) = info.name.split("/")
+		for name, data in BinaryRepo.read_tar(self._cache_db):
+			( binpkg_name, file_name ) = name.split("/")
 
-			pi = pkg_info.get(binpkg_name, {})
-			with tar.extractfile(info) as file:
-				pi[file_name] = [x.decode("utf-8").rstrip() for x in file.readlines()]
+			if binpkg_name != current:
+				if current is not None:
+					BinaryRepo.BinPkg(self, current, fields)
+				current = binpkg_name
+				fields = {}
 
-			if len(pi.keys() & { "desc", "depends" }) == 2:
-				BinaryRepo.BinPkg(self, pi["desc"], pi["depends"])
-				del pkg_info[binpkg_name]
+			if file_name not in ( "desc", "depends" ):
 				continue
 
-			pkg_info[binpkg_name] = pi
+			BinaryRepo.BinPkg.parse_fields(data, fields)
 
-		if len(pkg_info) != 0:
-			raise Exception("Incomplete packages in DB")
+		if current is not None:
+			BinaryRepo.BinPkg(self, current, fields)
 
+		self._stamp = stamp
+		self.save_snapshot(stamp)
 		print(" done")
+		return True
 
-	def get_sourceball(self, name, ver):
-		prefix = "{0}/{1}/".format(self._name, name)
-		prefix_len = len(prefix)
+	def file_stamp(path):
+		st = os.stat(path)
+		digest = hashlib.sha256()
+
+		with open(path, "rb") as fp:
+			for chunk in iter(lambda: fp.read(1 << 20), b""):
+				digest.update(chunk)
+
+		return (st.st_size, st.st_mtime_ns, digest.hexdigest())
+
+	def load_snapshot(self, stamp):
+		# Snapshots hold the parsed packages of a DB, pickled with
+		# references to this repo stubbed out. They are only used if the DB
+		# still has the size, mtime & hash it had when the snapshot was
+		# taken.
+		try:
+			with open(self._cache_snapshot, "rb") as fp:
+				if pickle.load(fp) != (BinaryRepo._snapshot_version, stamp):
+					return False
+
+				unpickler = pickle.Unpickler(fp)
+				unpickler.persistent_load = lambda pid: self
+				self._pkgs = unpickler.load()
+		except FileNotFoundError:
+			return False
+		except Exception as ex:
+			print(" bad snapshot ({0}),".format(ex), end="", flush=True)
+			return False
+
+		return True
+
+	def save_snapshot(self, stamp):
+		tmp = "{0}.tmp".format(self._cache_snapshot)
+
+		try:
+			with open(tmp, "wb") as fp:
+				pickle.dump((BinaryRepo._snapshot_version, stamp), fp)
+
+				pickler = pickle.Pickler(fp, pickle.HIGHEST_PROTOCOL)
+				pickler.persistent_id = lambda obj: "repo" if obj is self else None
+				pickler.dump(self._pkgs)
+
+			os.replace(tmp, self._cache_snapshot)
+		except Exception as ex:
+			print(" failed to save snapshot ({0}),".format(ex), end="", flush=True)
+			if os.path.exists(tmp):
+				os.unlink(tmp)
+
+	def read_tar(path, all_members=False, only=None):
+		# Yields the name & content of each regular file in a (possibly
+		# compressed) tarball, decompressing it incrementally. This avoids
+		# the per-block overhead of tarfile's stream mode, which otherwise
+		# dominates reading a sync DB. With all_members, directories,
+		# links & the like are also yielded, with None as their content.
+		# If only is given, content is only returned for the files it
+		# names, & that of others is skipped without being buffered.
+		# path may instead be a file already open for reading, which is
+		# read sequentially without seeking.
+		if not isinstance(path, str):
+			yield from BinaryRepo.read_tar_fp(path, all_members, only)
+			return
+
+		with open(path, "rb") as fp:
+			yield from BinaryRepo.read_tar_fp(fp, all_members, only)
+
+	def read_tar_fp(fp, all_members, only):
+		chunk = fp.read(1 << 20)
+		magic = chunk[:6]
+
+		if magic[:2] == b"\x1f\x8b":
+			decomp = zlib.decompressobj(zlib.MAX_WBITS | 16)
+		elif magic == b"\xfd7zXZ\x00":
+			decomp = lzma.LZMADecompressor()
+		elif magic[:3] == b"BZh":
+			decomp = bz2.BZ2Decompressor()
+		else:
+			decomp = None
+
+		buf = bytearray()
+		pos = 0
+		skip = 0
+		long_name = None
+		eof = False
+
+		while not eof:
+			if len(chunk) == 0:
+				eof = True
+			elif decomp is not None:
+				chunk = decomp.decompress(chunk)
+
+			del buf[:pos]
+			buf += chunk
+			pos = 0
+
+			while True:
+				# content being skipped may run on past what we have
+				if skip > 0:
+					n = min(skip, len(buf) - pos)
+					pos += n
+					skip -= n
+					if skip > 0:
+						break
+
+				if len(buf) - pos < 512:
+					break
+
+				header = bytes(buf[pos:pos + 512])
+				if header.count(0) == 512:
+					return
+
+				size = int(header[124:136].strip(b"\0 ") or b"0", 8)
+				padded = (size + 511) & ~511
+				kind = header[156:157]
+
+				if kind in ( b"x", b"L" ):
+					if pos + 512 + padded > len(buf):
+						break
+					data = bytes(buf[pos + 512:pos + 512 + size])
+					pos += 512 + padded
+
+					if kind == b"x":
+						# pax extended header, may carry a long path
+						for rec in data.decode("utf-8").split("\n"):
+							key, _dummy, value = rec.partition(" ")[2].partition("=")
+							if key == "path":
+								long_name = value
+					else:
+						long_name = data.rstrip(b"\0").decode("utf-8")
+					continue
 
-		out_data = io.BytesIO()
+				# global pax headers & GNU long link names aren't needed
+				if kind in ( b"g", b"K" ):
+					pos += 512
+					skip = padded
+					continue
+
+				regular = kind in ( b"0", b"\0" )
+				if not regular and not all_members:
+					long_name = None
+					pos += 512
+					skip = padded
+					continue
+
+				if long_name is not None:
+					name = long_name
+				else:
+					name = header[0:100].rstrip(b"\0").decode("utf-8")
+					if header[257:262] == b"ustar":
+						prefix = header[345:500].rstrip(b"\0").decode("utf-8")
+						if len(prefix) > 0:
+							name = "{0}/{1}".format(prefix, name)
+
+				if regular and (only is None or name in only):
+					if pos + 512 + padded > len(buf):
+						break
+					data = bytes(buf[pos + 512:pos + 512 + size])
+					pos += 512 + padded
+				else:
+					data = None
+					pos += 512
+					skip = padded
+
+				long_name = None
+				yield name, data
+
+			chunk = fp.read(1 << 20)
+
+	def index_sources(self):
+		# Splits the ABS tarball into one uncompressed tarball per package,
+		# in the form get_sourceball returns, so that serving sources is a
+		# single small read. Only done when the ABS tarball has changed.
+		# Each index is written to a new directory, & the src.d symlink
+		# then pointed at it, so that readers always see one whole index.
+		if self._cache_src is None or not os.path.exists(self._cache_src):
+			return
+
+		st = os.stat(self._cache_src)
+		stamp = "{0} {1}".format(st.st_size, st.st_mtime_ns)
+		stamp_path = os.path.join(self._cache_src_dir, ".stamp")
+
+		try:
+			with open(stamp_path, "r") as fp:
+				if fp.read() == stamp:
+					return
+		except FileNotFoundError:
+			pass
+
+		print("Indexing {0}...".format(self._cache_src), end="", flush=True)
+
+		cache_dir = os.path.dirname(self._cache_src_dir)
+		base = os.path.basename(self._cache_src_dir)
+		tmp_dir = tempfile.mkdtemp(prefix="{0}.".format(base), dir=cache_dir)
+		os.chmod(tmp_dir, 0o755)
+
+		prefix = "{0}/".format(self._name)
+		prefix_len = len(prefix)
+		current = None
+		written = set()
+		out_tar = None
 
-		with tarfile.open(fileobj=out_data, mode="w") as out_tar:
-			with tarfile.open(self._cache_src) as in_tar:
+		try:
+			with tarfile.open(self._cache_src, mode="r|*") as in_tar:
 				for m in in_tar:
 					if not m.name.startswith(prefix):
 						continue
 
-					fname = m.name[prefix_len:]
+					( name, _dummy, fname ) = m.name[prefix_len:].partition("/")
+					if len(fname) == 0:
+						continue
+
+					if name != current:
+						if out_tar is not None:
+							out_tar.close()
+
+						# append should a package's files not be contiguous
+						mode = "a" if name in written else "w"
+						out_tar = tarfile.open(os.path.join(tmp_dir, name), mode=mode)
+						written.add(name)
+						current = name
 
 					info = tarfile.TarInfo(fname)
 					info.size = m.size
 					info.mtime = m.mtime
 					info.mode = m.mode
 					info.type = m.type
-					out_tar.addfile(info, in_tar.extractfile(m))
+					info.linkname = m.linkname
+					out_tar.addfile(info, in_tar.extractfile(m) if m.isreg() else None)
+
+			if out_tar is not None:
+				out_tar.close()
+				out_tar = None
+
+			with open(os.path.join(tmp_dir, ".stamp"), "w") as fp:
+				fp.write(stamp)
+		except:
+			if out_tar is not None:
+				out_tar.close()
+			shutil.rmtree(tmp_dir, ignore_errors=True)
+			raise
+
+		# Older versions renamed a plain directory into place
+		if os.path.isdir(self._cache_src_dir) and not os.path.islink(self._cache_src_dir):
+			shutil.rmtree(self._cache_src_dir)
+
+		target = os.path.basename(tmp_dir)
+		tmp_link = "{0}.{1}.tmp".format(self._cache_src_dir, os.getpid())
+		if os.path.lexists(tmp_link):
+			os.unlink(tmp_link)
+		os.symlink(target, tmp_link)
+		os.replace(tmp_link, self._cache_src_dir)
+
+		# Anything a request still has open stays readable once removed
+		for entry in os.listdir(cache_dir):
+			if entry.startswith("{0}.".format(base)) and entry != target:
+				path = os.path.join(cache_dir, entry)
+				if os.path.isdir(path) and not os.path.islink(path):
+					shutil.rmtree(path, ignore_errors=True)
+
+		print(" {0} packages".format(len(written)))
+
+	def get_sourceball(self, name, ver):
+		# name comes from clients, so only plain package names are looked
+		# up, never anything else in or outside the index
+		if self._cache_src_dir is None or os.path.basename(name) != name or name.startswith("."):
+			return None
 
-		return out_data
+		try:
+			with open(os.path.join(self._cache_src_dir, name), "rb") as fp:
+				return io.BytesIO(fp.read())
+		except OSError:
+			return None
 
 	class SrcPkg(SrcPkg):
+		__slots__ = ()
+
 		def __init__(self, repo, name, ver):
 			SrcPkg.__init__(self, repo, name, ver)
 
 	class BinPkg(BinPkg):
-		def __init__(self, repo, desc, deps):
-			desc = BinaryRepo.BinPkg.parse_arrays(desc)
-			deps = BinaryRepo.BinPkg.parse_arrays(deps)
+		__slots__ = ()
+
+		def __init__(self, repo, entry, fields):
+			if not "name" in fields or not "version" in fields:
+				raise Exception("Incomplete package {0} in DB".format(entry))
 
-			name = desc["name"][0]
-			ver = PkgVersion.parse(desc["version"][0])
+			name = fields["name"][0]
+			ver = PkgVersion.parse(fields["version"][0])
 
-			base = desc.get("base", [name])[0]
+			base = fields.get("base", [name])[0]
 			srcpkg = repo._pkgs.get(base, None)
 			if srcpkg is None:
 				srcpkg = BinaryRepo.SrcPkg(repo, base, ver)
@@ -138,36 +432,27 @@ class BinaryRepo(Repo):
 
 			BinPkg.__init__(self, srcpkg, name, ver)
 
-			self._desc = desc.get("desc", [""])[0]
-			self._deps = set([PkgDep(d) for d in deps.get("depends", [])])
-			self._groups = set(desc.get("groups", []))
-
-			srcpkg._pkgs[name] = self
+			self._desc = fields.get("desc", [""])[0]
+			self._deps = PkgDep.intern_all(fields.get("depends", []))
+			self._groups = frozenset([ sys.intern(g) for g in fields.get("groups", []) ])
 
-			for d in deps.get("checkdepends", []):
-				srcpkg._checkdeps.add(PkgDep(d))
-			for d in deps.get("makedepends", []):
-				srcpkg._makedeps.add(PkgDep(d))
+			srcpkg._pkgs[self._name] = self
 
-		def parse_arrays(lines):
-			ret = {}
-			current = None
-			current_name = None
-
-			for l in lines:
-				if len(l) == 0:
-					if current is not None:
-						ret[current_name] = current
-					current = None
-					continue
+			if "checkdepends" in fields:
+				srcpkg._checkdeps |= PkgDep.intern_all(fields["checkdepends"])
+			if "makedepends" in fields:
+				srcpkg._makedeps |= PkgDep.intern_all(fields["makedepends"])
 
-				if current is None:
-					if not l.startswith("%") or not l.endswith("%"):
-						raise Exception("Invalid start line '{0}'".format(l))
-					current = []
-					current_name = l.strip("%").lower()
+		def parse_fields(data, fields):
+			# Parses the %FIELD% blocks of a desc or depends file into
+			# fields, mapping each lowercased field name to its lines
+			for block in data.decode("utf-8").split("\n\n"):
+				lines = block.strip("\n").split("\n")
+				if len(lines[0]) == 0:
 					continue
 
-				current.append(l)
+				name = lines[0]
+				if not name.startswith("%") or not name.endswith("%"):
+					raise Exception("Invalid start line '{0}'".format(name))
 
-			return ret
+				fields[name.strip("%").lower()] = lines[1:]
@@ -2,8 +2,6 @@ import argparse
 import base64
 import json
 import os
-import rethinkdb
-import shutil
 import sys
 import tarfile
 import tempfile
@@ -16,15 +14,21 @@ from clientcmd import ClientCmd
 from daemoncmd import DaemonCmd
 from config import Config
 from db import DB
+from utils import place_file
 
 class Cmd(Enum):
 	ready = 1
 	receive = 2
 	source = 3
+	plan = 4
+	cycles = 5
 
 class ArchitectBuildDaemon(DaemonCmd):
 	cmd_name = "build"
 
+	# The size of each frame raw sourceballs are sent in
+	_source_chunk = 1 << 20
+
 	def __init__(self, daemon):
 		super().__init__(daemon)
 
@@ -32,6 +36,8 @@ class ArchitectBuildDaemon(DaemonCmd):
 			Cmd.ready: ArchitectBuildDaemon.handle_ready,
 			Cmd.receive: ArchitectBuildDaemon.handle_receive,
 			Cmd.source: ArchitectBuildDaemon.handle_source,
+			Cmd.plan: ArchitectBuildDaemon.handle_plan,
+			Cmd.cycles: ArchitectBuildDaemon.handle_cycles,
 		}
 
 	def handle_ready(self, req):
@@ -42,30 +48,61 @@ class ArchitectBuildDaemon(DaemonCmd):
 			} for p in self._pkg_graph.ready_for_build() ],
 		}
 
-	def handle_receive(self, req):
-		repo = None
-		for r in self._pkg_graph.repos:
-			if r.name == req["repository"]:
-				repo = r
-				break
+	def handle_plan(self, req):
+		plan = self._pkg_graph.build_plan()
 
-		if repo is None:
+		return {
+			"generation": plan.generation,
+			"waves": [[{
+				"id": p.id,
+				"version": str(p.source.version),
+				"priority": priority,
+			} for p, priority in wave ] for wave in plan.waves ],
+			"blocked": [{
+				"id": p.id,
+				"version": str(p.source.version),
+				"reasons": reasons,
+			} for p, reasons in plan.blocked ],
+			"cyclic": [{
+				"id": p.id,
+				"version": str(p.source.version),
+			} for p in plan.cyclic ],
+		}
+
+	def handle_cycles(self, req):
+		return {
+			"cycles": [{
+				"pkgs": [ p.id for p in members ],
+				"break": [{
+					"pkg": p.id,
+					"kind": kind,
+					"dep": name,
+					"provider": provider.id,
+				} for p, kind, name, provider in breaks ],
+			} for members, breaks in self._pkg_graph.find_cycles() ],
+		}
+
+	def handle_receive(self, req):
+		if req["repository"] not in [ r.name for r in self._pkg_graph.repos ]:
 			return { "error": "Unknown repository '{0}'".format(req["repository"]) }
 
+		# Uploads to a repo are queued, to be added alongside any others
+		# arriving at about the same time
+		queue = self.daemon.ingest_queue(self._pkg_graph.arch, req["repository"])
+
 		try:
-			repo._dst.add_packages(req["packages"], tmp_dir=req["dir"])
+			queue.add(req["packages"])
 		except Exception as e:
 			return { "error": "Exception: {0}".format(str(e)) }
 
+		build = DB.new_build(self._pkg_graph.arch, req["pkg"], req["version"], "success")
+		build_id = build["id"]
+
 		try:
-			db_result = DB.insert_build({
-				"arch": self._pkg_graph.arch,
-				"pkg": req["pkg"],
-				"version": req["version"],
-				"status": "success",
-				"time_upload": rethinkdb.now(),
-			})
-			build_id = db_result["generated_keys"][0]
+			if Config.db_async_writes():
+				DB.insert_build_async(build)
+			else:
+				DB.insert_build(build)
 		except Exception as e:
 			return { "error": "Failed DB insert: {0}".format(repr(e)) }
 
@@ -80,7 +117,7 @@ class ArchitectBuildDaemon(DaemonCmd):
 
 			for src_path in req["logs"]:
 				dst_path = os.path.join(log_dir, os.path.basename(src_path))
-				shutil.copyfile(src_path, dst_path)
+				place_file(src_path, dst_path)
 		except Exception as e:
 			return { "error": "Failed to copy logs: {0}".format(str(e)) }
 
@@ -106,9 +143,18 @@ class ArchitectBuildDaemon(DaemonCmd):
 			return { "error": "404" }
 
 		srcball = src.get_sourceball()
-		if src is None:
+		if srcball is None:
 			return { "error": "404" }
 
+		# Clients which predate raw transfers expect base64 in the reply
+		if req.get("encoding", "base64") == "raw":
+			buf = srcball.getbuffer()
+			chunk = ArchitectBuildDaemon._source_chunk
+			return {
+				"size": len(buf),
+				"frames": [ buf[i:i + chunk] for i in range(0, len(buf), chunk) ],
+			}
+
 		return {
 			"srcball": base64.b64encode(srcball.getbuffer()).decode("utf-8"),
 		}
@@ -129,6 +175,8 @@ class ArchitectBuildClient(ClientCmd):
 			Cmd.ready: ArchitectBuildClient.handle_ready,
 			Cmd.receive: ArchitectBuildClient.handle_receive,
 			Cmd.source: ArchitectBuildClient.handle_source,
+			Cmd.plan: ArchitectBuildClient.handle_plan,
+			Cmd.cycles: ArchitectBuildClient.handle_cycles,
 		}
 
 	def setup_args(subparsers):
@@ -141,6 +189,14 @@ class ArchitectBuildClient(ClientCmd):
 		parser.set_defaults(bcmd=Cmd.ready)
 		parser.add_argument("--json", action='store_true', help="Output as JSON")
 
+		parser = subparsers.add_parser("plan", help="Order all required builds into waves")
+		parser.set_defaults(bcmd=Cmd.plan)
+		parser.add_argument("--json", action='store_true', help="Output as JSON")
+
+		parser = subparsers.add_parser("cycles", help="Find dependency cycles blocking builds")
+		parser.set_defaults(bcmd=Cmd.cycles)
+		parser.add_argument("--json", action='store_true', help="Output as JSON")
+
 		parser = subparsers.add_parser("receive", help="Receive a completed build")
 		parser.set_defaults(bcmd=Cmd.receive)
 		parser.add_argument("repository", type=str, help="Destination repository")
@@ -151,6 +207,10 @@ class ArchitectBuildClient(ClientCmd):
 		parser.set_defaults(bcmd=Cmd.source)
 		parser.add_argument("package", type=str, help="Package ID")
 		parser.add_argument("version", type=str, help="Package version")
+		parser.add_argument("--output", "-o", type=str, default=None,
+				    help="Write the sourceball to a file rather than stdout")
+		parser.add_argument("--base64", action='store_true',
+				    help="Print the sourceball base64 encoded")
 
 	def run(self, args):
 		if not "bcmd" in args:
@@ -189,6 +249,59 @@ class ArchitectBuildClient(ClientCmd):
 
 		return 0
 
+	def handle_plan(self, args):
+		reply = self.send({
+			"cmd" : ArchitectBuildDaemon.cmd_name,
+			"bcmd": args.bcmd.name,
+		})
+
+		if "error" in reply:
+			print("Error: {0}".format(reply["error"]))
+			return 1
+
+		if "json" in args and args.json:
+			print(json.dumps(reply, indent=4))
+			return 0
+
+		for i, wave in enumerate(reply["waves"]):
+			print("Wave {0}:".format(i + 1))
+			for pkg in wave:
+				print("  {0} {1} (unblocks {2})".format(pkg["id"], pkg["version"], pkg["priority"]))
+
+		if len(reply["cyclic"]) > 0:
+			print("Cyclic:")
+			for pkg in reply["cyclic"]:
+				print("  {0} {1}".format(pkg["id"], pkg["version"]))
+
+		if len(reply["blocked"]) > 0:
+			print("Blocked:")
+			for pkg in reply["blocked"]:
+				print("  {0} {1}: {2}".format(pkg["id"], pkg["version"], ", ".join(pkg["reasons"])))
+
+		return 0
+
+	def handle_cycles(self, args):
+		reply = self.send({
+			"cmd" : ArchitectBuildDaemon.cmd_name,
+			"bcmd": args.bcmd.name,
+		})
+
+		if "error" in reply:
+			print("Error: {0}".format(reply["error"]))
+			return 1
+
+		if "json" in args and args.json:
+			print(json.dumps(reply, indent=4))
+			return 0
+
+		for cycle in reply["cycles"]:
+			print("Cycle: {0}".format(" ".join(cycle["pkgs"])))
+			for edge in cycle["break"]:
+				print("  break {0} {1} {2} (from {3})".format(
+					edge["pkg"], edge["kind"], edge["dep"], edge["provider"]))
+
+		return 0
+
 	def handle_receive(self, args):
 		with tempfile.TemporaryDirectory() as tmp_dir:
 			with tarfile.open(fileobj=sys.stdin.buffer, mode="r|") as tar:
@@ -243,11 +356,28 @@ class ArchitectBuildClient(ClientCmd):
 			"bcmd": args.bcmd.name,
 			"pkg": args.package,
 			"version": args.version,
+			"encoding": "base64" if args.base64 else "raw",
 		})
 
 		if "error" in reply:
-			print("Error: {0}".format(reply["error"]))
+			print("Error: {0}".format(reply["error"]), file=sys.stderr)
 			return 1
 
-		print(reply["srcball"])
+		if args.base64:
+			data = [ reply["srcball"].encode("utf-8"), b"\n" ]
+		else:
+			data = reply.get("frames", [])
+			if sum([ len(f) for f in data ]) != reply["size"]:
+				print("Error: received a truncated sourceball", file=sys.stderr)
+				return 1
+
+		if args.output is not None:
+			with open(args.output, "wb") as fp:
+				for d in data:
+					fp.write(d)
+		else:
+			for d in data:
+				sys.stdout.buffer.write(d)
+			sys.stdout.buffer.flush()
+
 		return 0
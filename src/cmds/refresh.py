@@ -1,3 +1,6 @@
+import json
+import time
+
 from clientcmd import ClientCmd
 from daemoncmd import DaemonCmd
 
@@ -5,19 +8,92 @@ class ArchitectRefreshDaemon(DaemonCmd):
 	cmd_name = "refresh"
 
 	def run(self, req):
-		self.graph.refresh()
-		return {}
+		# Refreshes run in the background. Without a job id this asks for
+		# one, returning the job which will do it; with one it returns the
+		# progress of that job.
+		if "job" in req:
+			job = self.daemon.refresher.job(req["job"])
+			if job is None:
+				return { "error": "unknown job {0}".format(req["job"]) }
+		else:
+			job = self.daemon.refresher.queue("requested")
+
+		return { "job": job.to_json() }
 
 class ArchitectRefreshClient(ClientCmd):
+	# How often, in seconds, to poll the progress of a job being waited on
+	_poll_interval = 1
+
 	def setup_args(subparsers):
 		parser = subparsers.add_parser("refresh", help="Refresh packages")
 		parser.set_defaults(cmd=ArchitectRefreshClient)
+		parser.add_argument("--job", type=int, default=None,
+				    help="Show the progress of a refresh rather than starting one")
+		parser.add_argument("--wait", action='store_true',
+				    help="Follow the refresh's progress until it completes")
+		parser.add_argument("--json", action='store_true', help="Output as JSON")
 
 	def run(self, args):
-		reply = self.send({ "cmd" : ArchitectRefreshDaemon.cmd_name })
+		req = { "cmd" : ArchitectRefreshDaemon.cmd_name }
+		if args.job is not None:
+			req["job"] = args.job
+
+		reply = self.send(req)
 
 		if "error" in reply:
 			print("Error: {0}".format(reply["error"]))
 			return 1
 
-		return 0
+		job = reply["job"]
+
+		if args.job is None and not args.json:
+			print("Refresh job {0} {1}".format(job["id"], job["state"]))
+
+		if args.wait:
+			printed = 0
+			while True:
+				if not args.json:
+					printed = ArchitectRefreshClient.print_stages(job, printed)
+				if job["state"] in ( "done", "failed" ):
+					break
+
+				time.sleep(ArchitectRefreshClient._poll_interval)
+				reply = self.send({ "cmd" : ArchitectRefreshDaemon.cmd_name, "job": job["id"] })
+				if "error" in reply:
+					print("Error: {0}".format(reply["error"]))
+					return 1
+				job = reply["job"]
+
+		if args.json:
+			print(json.dumps(job, indent=4))
+		elif args.job is not None or args.wait:
+			if not args.wait:
+				ArchitectRefreshClient.print_stages(job, 0)
+			ArchitectRefreshClient.print_job(job)
+
+		return 0 if job["state"] != "failed" else 1
+
+	def print_stages(job, printed):
+		# Prints the finished stages beyond the first printed, returning
+		# how many have now been printed. Stages are only printed once
+		# finished, and in the order they started, so that one still
+		# running holds back those after it.
+		stages = job["stages"]
+
+		while printed < len(stages) and stages[printed]["seconds"] is not None:
+			s = stages[printed]
+			status = "failed: {0}".format(s["error"]) if s["error"] is not None else "done"
+			print("  {0:<24} {1:<12} {2:8.2f}s {3}".format(s["part"], s["stage"], s["seconds"], status))
+			printed += 1
+
+		return printed
+
+	def print_job(job):
+		print("Refresh job {0} ({1}, {2} request{3}): {4}".format(
+			job["id"], job["reason"], job["requests"],
+			"" if job["requests"] == 1 else "s", job["state"]))
+
+		if job["started"] is not None and job["finished"] is not None:
+			print("  took {0:.2f}s".format(job["finished"] - job["started"]))
+		if job["error"] is not None:
+			print("  error: {0}".format(job["error"]))
@@ -9,6 +9,8 @@ from db import DB
 
 class Stats(Enum):
 	recent_builds = 1
+	ingest = 2
+	db = 3
 
 class StatsFormat(Enum):
 	json = 1
@@ -22,8 +24,16 @@ class ArchitectStatsDaemon(DaemonCmd):
 
 		self._handlers = {
 			Stats.recent_builds: ArchitectStatsDaemon.handle_recent_builds,
+			Stats.ingest: ArchitectStatsDaemon.handle_ingest,
+			Stats.db: ArchitectStatsDaemon.handle_db,
 		}
 
+	def handle_db(self, req):
+		return DB.metrics()
+
+	def handle_ingest(self, req):
+		return { "queues": [ q.metrics() for q in self.daemon.ingest_queues() ] }
+
 	def handle_recent_builds(self, req):
 		show_all = "all" in req and req["all"]
 
@@ -43,6 +53,8 @@ class ArchitectStatsClient(ClientCmd):
 
 		self._text_printers = {
 			Stats.recent_builds: ArchitectStatsClient.print_recent_builds,
+			Stats.ingest: ArchitectStatsClient.print_ingest,
+			Stats.db: ArchitectStatsClient.print_db,
 		}
 
 	def setup_args(subparsers):
@@ -57,6 +69,14 @@ class ArchitectStatsClient(ClientCmd):
 				    help="The number of packages to list")
 		parser.add_argument("--json", action='store_true', help="Output as JSON")
 
+		parser = subparsers.add_parser("ingest", help="Upload queue depths & batch sizes")
+		parser.set_defaults(stat=Stats.ingest)
+		parser.add_argument("--json", action='store_true', help="Output as JSON")
+
+		parser = subparsers.add_parser("db", help="Build history connection pool & writer")
+		parser.set_defaults(stat=Stats.db)
+		parser.add_argument("--json", action='store_true', help="Output as JSON")
+
 	def run(self, args):
 		if not "stat" in args:
 			print("No stat specified")
@@ -90,3 +110,23 @@ class ArchitectStatsClient(ClientCmd):
 	def print_recent_builds(self, json):
 		for build in json["builds"]:
 			print("{0} {1}".format(build["pkg"], build["version"]))
+
+	def print_ingest(self, json):
+		for q in json["queues"]:
+			print("{0}/{1}: depth {2}, adding {3}, {4} uploads in {5} batches "
+			      "(mean {6:.1f}, max {7}), {8} retried, {9} failed".format(
+				q["repo"], q["arch"], q["depth"], q["adding"], q["uploads"], q["batches"],
+				q["mean_batch"], q["max_batch"], q["retries"], q["failed"]))
+
+	def print_db(self, json):
+		print("Backend: {0}".format(json["backend"]))
+
+		pool = json["pool"]
+		if pool is not None:
+			print("Pool: {0} idle, {1} opened, {2} reused, {3} discarded".format(
+				pool["idle"], pool["opened"], pool["reused"], pool["discarded"]))
+
+		writer = json["writer"]
+		if writer is not None:
+			print("Writer: {0} buffered, {1} written, {2} retries, {3} dropped".format(
+				writer["buffered"], writer["written"], writer["retries"], writer["dropped"]))
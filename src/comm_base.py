@@ -1,3 +1,5 @@
+import json
+
 from datetime import datetime
 
 import zmq
@@ -34,4 +36,11 @@ class CommBase:
 			if not poller.poll(timeout):
 				return { "error": "Receive Timeout" }
 
-		return self._socket.recv_json()
+		# Replies may be followed by frames of binary data, which are
+		# passed back in the reply as a list under "frames"
+		frames = self._socket.recv_multipart()
+		reply = json.loads(frames[0].decode("utf-8"))
+		if len(frames) > 1:
+			reply["frames"] = frames[1:]
+
+		return reply
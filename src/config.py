@@ -32,15 +32,60 @@ class Config:
 	def cache_dir():
 		return Config.get_path("cache_dir")
 
+	def db_async_writes():
+		return Config._json.get("db_async_writes", True)
+
+	def db_backend():
+		return Config._json.get("db_backend", "rethinkdb")
+
 	def db_host():
 		return Config._json.get("db_host", "localhost")
 
 	def db_name():
 		return Config._json.get("db_name", "archlinuxmips")
 
+	def db_memory_latency():
+		return Config._json.get("db_memory_latency", 0.001)
+
+	def db_pool_check_after():
+		return Config._json.get("db_pool_check_after", 30)
+
+	def db_pool_size():
+		return Config._json.get("db_pool_size", 4)
+
 	def db_port():
 		return Config._json.get("db_port", 28015)
 
+	def db_write_buffer():
+		return Config._json.get("db_write_buffer", 1000)
+
+	def db_write_retries():
+		return Config._json.get("db_write_retries", 5)
+
+	def db_write_timeout():
+		return Config._json.get("db_write_timeout", 5)
+
+	def download_timeout():
+		return Config._json.get("download_timeout", 60)
+
+	def download_workers():
+		return Config._json.get("download_workers", 4)
+
+	def ingest_batch():
+		return Config._json.get("ingest_batch", 32)
+
+	def ingest_window():
+		return Config._json.get("ingest_window", 0.25)
+
+	def parse_workers():
+		return Config._json.get("parse_workers", os.cpu_count() or 1)
+
+	def refresh_interval():
+		return Config._json.get("refresh_interval", 0)
+
+	def rpc_workers():
+		return Config._json.get("rpc_workers", 4)
+
 	def rpc_addr():
 		return Config._json.get("rpc_addr", "tcp://127.0.0.1:7773")
 
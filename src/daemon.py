@@ -1,12 +1,22 @@
+import json
+import threading
 import zmq
 
 from cmd_loader import CmdLoader
 from comm_base import CommBase
 from config import Config
 from db import DB
+from ingest import IngestQueue
 from pkggraph import PkgGraph
+from refresher import Refresher
+from upstream import Upstreams
 
 class Daemon(CommBase):
+	_workers_addr = "inproc://workers"
+
+	# How often, in ms, blocked sockets check whether we're exiting
+	_poll_interval = 500
+
 	def __init__(self):
 		super().__init__()
 
@@ -14,43 +24,193 @@ class Daemon(CommBase):
 		for cmd in CmdLoader.load("Daemon"):
 			self._cmd_lookup[cmd.cmd_name] = cmd
 
-		self._pkg_graph = { a: PkgGraph(a) for a in Config.architectures() }
+		self._upstreams = Upstreams()
+		self._pkg_graph = { a: PkgGraph(a, self._upstreams) for a in Config.architectures() }
+		self._mutate_lock = threading.Lock()
+		self._refresher = Refresher(self)
+		self._ingest = {}
+		self._ingest_lock = threading.Lock()
 
 		self._exit = False
 
 	def do_connect(self):
-		self._socket = self._zctx.socket(zmq.REP)
+		# Clients talk to the front ROUTER. Worker threads connect to the
+		# back ROUTER, & each request is passed on to a worker which has
+		# said that it's free. Requests are never queued behind a worker
+		# that's busy with something slow, like a refresh.
+		self._socket = self._zctx.socket(zmq.ROUTER)
 		self._socket.bind(Config.rpc_addr())
 
+		self._backend = self._zctx.socket(zmq.ROUTER)
+		self._backend.bind(Daemon._workers_addr)
+
+	@property
+	def refresher(self):
+		return self._refresher
+
+	def ingest_queue(self, arch, repo):
+		with self._ingest_lock:
+			key = (arch, repo)
+			if not key in self._ingest:
+				self._ingest[key] = IngestQueue(self, arch, repo)
+			return self._ingest[key]
+
+	def ingest_queues(self):
+		with self._ingest_lock:
+			return list(self._ingest.values())
+
 	def graph(self, arch):
 		return self._pkg_graph.get(arch, None)
 
-	def run(self):
-		while not self._exit:
-			msg = self.recv(timeout=0)
-
-			print("Cmd: {0}".format({ k: msg.get(k, None) for k in ('cmd', 'arch') }))
-
-			if not "arch" in msg:
-				reply = { "error": "no arch specified" }
-			else:
-				pg = self.graph(msg["arch"])
-
-				if pg is None:
-					reply = { "error": "unsupported architecture" }
-				elif not "cmd" in msg:
-					reply = { "error": "no command specified" }
-				elif not msg["cmd"] in self._cmd_lookup:
-					reply = { "error": "unknown command" }
-				else:
-					try:
-						reply = self._cmd_lookup[msg["cmd"]](self).invoke(pg, msg)
-					except Exception as ex:
-						reply = { "error": str(ex) }
+	def mutate(self, fn):
+		# Graphs are never modified whilst requests may be reading them.
+		# Instead fn is given copies of them all to modify, which are then
+		# swapped in together. Mutations run one at a time, whilst requests
+		# carry on being served from the graphs they started with.
+		with self._mutate_lock:
+			graphs = dict([ (a, pg.clone()) for a, pg in self._pkg_graph.items() ])
+			result = fn(graphs)
+			self._pkg_graph = graphs
+
+		return result
+
+	def refresh(self, progress=None):
+		# Each upstream is refreshed once, then every architecture's graph
+		# is updated from the changes. Clients ask the refresher to call
+		# this in the background rather than waiting on it. Should any of
+		# it fail, the new graphs are thrown away, & the repos hand out the
+		# same changes again next time. Downloads & git pulls come first,
+		# so that uploads needn't wait on them to mutate the graphs.
+		self._upstreams.fetch(progress)
+
+		def apply(graphs):
+			changes = self._upstreams.refresh(progress)
+			for pg in graphs.values():
+				pg.refresh(changes, progress)
+
+		self.mutate(apply)
+
+		self._upstreams.applied()
+		for pg in self._pkg_graph.values():
+			pg.applied()
+
+	def handle(self, msg):
+		print("Cmd: {0}".format({ k: msg.get(k, None) for k in ('cmd', 'arch') }))
+
+		if not "arch" in msg:
+			return { "error": "no arch specified" }
+
+		pg = self.graph(msg["arch"])
+
+		if pg is None:
+			return { "error": "unsupported architecture" }
+		if not "cmd" in msg:
+			return { "error": "no command specified" }
+		if not msg["cmd"] in self._cmd_lookup:
+			return { "error": "unknown command" }
+
+		try:
+			return self._cmd_lookup[msg["cmd"]](self).invoke(pg, msg)
+		except Exception as ex:
+			return { "error": str(ex) }
+
+	def worker(self):
+		socket = self._zctx.socket(zmq.REQ)
+		socket.setsockopt(zmq.LINGER, Daemon._poll_interval)
+		socket.connect(Daemon._workers_addr)
+
+		poller = zmq.Poller()
+		poller.register(socket, zmq.POLLIN)
+
+		# an empty message says we're ready for a request
+		socket.send(b"")
+
+		# Once we're exiting, any request already passed on is still
+		# answered before stopping
+		while True:
+			if not poller.poll(Daemon._poll_interval):
+				if self._exit:
+					break
+				continue
+
+			( client, empty, request ) = socket.recv_multipart()
+
+			# Commands may return binary data as a list of buffers under
+			# "frames", which are sent after the reply as they are rather
+			# than being encoded into it
+			frames = []
 
 			try:
-				self.send(reply, response=False)
+				reply = self.handle(json.loads(request.decode("utf-8")))
+				frames = reply.pop("frames", [])
+				if len(frames) > 0:
+					reply["frames"] = len(frames)
+				reply = json.dumps(reply, default=CommBase.json_serialisable)
 			except Exception as ex:
-				print(ex)
+				frames = []
+				reply = json.dumps({ "error": str(ex) })
+
+			socket.send_multipart([ client, b"", reply.encode("utf-8") ] + frames, copy=False)
+
+		socket.close()
+
+	def run(self):
+		self.connect()
+
+		workers = [ threading.Thread(target=self.worker, daemon=True)
+			    for i in range(Config.rpc_workers()) ]
+		for w in workers:
+			w.start()
+
+		self._refresher.start()
+
+		idle = []
+
+		while not self._exit:
+			self.forward(idle, Daemon._poll_interval)
+
+		# Take no more requests, but pass on the replies to those being
+		# handled, including whatever asked us to exit, until every worker
+		# has stopped
+		while any([ w.is_alive() for w in workers ]):
+			self.forward(idle, Daemon._poll_interval, accept=False)
+		while self.forward(idle, 0, accept=False):
+			pass
+
+		# allow the last replies a little while to reach their clients
+		self._backend.close(linger=0)
+		self._socket.close(linger=Daemon._poll_interval * 2)
+		self._zctx.term()
+
+		self._refresher.join()
+
+		DB.close()
 
 		return 0
+
+	def forward(self, idle, timeout, accept=True):
+		# Only take requests from clients whilst a worker is free to
+		# handle them, leaving the rest queued in the front socket.
+		# Returns whether a worker replied.
+		poller = zmq.Poller()
+		poller.register(self._backend, zmq.POLLIN)
+		if accept and len(idle) > 0:
+			poller.register(self._socket, zmq.POLLIN)
+
+		events = dict(poller.poll(timeout))
+
+		if self._backend in events:
+			# replies may carry large binary frames, so avoid copying them
+			msg = self._backend.recv_multipart(copy=False)
+			idle.append(msg[0].bytes)
+
+			# anything beyond [ worker, empty, empty ] is a reply
+			if len(msg) > 3:
+				self._socket.send_multipart(msg[2:], copy=False)
+
+		# we may have started exiting whilst polling
+		if self._socket in events and not self._exit:
+			request = self._socket.recv_multipart()
+			self._backend.send_multipart([ idle.pop(0), b"" ] + request)
+
+		return self._backend in events
@@ -1,24 +1,468 @@
+import bisect
+import queue
+import sys
+import threading
+import time
+import uuid
+
 import rethinkdb as r
 
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
 from config import Config
 
 class DB:
-	def connect():
-		conn = r.connect(Config.db_host(), Config.db_port())
-		conn.use(Config.db_name())
-		return conn
+	# The build history. Calls go to the backend named by
+	# Config.db_backend(): RethinkDB, or an in-memory stand-in which allows
+	# the rest to be tested & benchmarked without a server.
+	_backend = None
+	_writer = None
+	_lock = threading.Lock()
 
-	def recent_builds(n=10, show_all=False):
-		with DB.connect() as conn:
-			q = r.table("builds")
+	class Pool:
+		# Connections are reused rather than opened for each call, up to
+		# size of them at once. One which has been idle for check_after
+		# seconds is checked before being reused, in case the server has
+		# dropped it, & one which a call fails on is thrown away.
+		def __init__(self, connect, check, size, check_after):
+			self._connect = connect
+			self._check = check
+			self._check_after = check_after
+			self._slots = threading.BoundedSemaphore(size)
+			self._lock = threading.Lock()
+			self._idle = []
+
+			self._opened = 0
+			self._reused = 0
+			self._discarded = 0
+
+		@contextmanager
+		def connection(self):
+			with self._slots:
+				conn = self.get()
+
+				try:
+					yield conn
+				except:
+					self.discard(conn)
+					raise
+
+				with self._lock:
+					self._idle.append((conn, time.time()))
+
+		def get(self):
+			while True:
+				with self._lock:
+					if len(self._idle) == 0:
+						break
+					( conn, used ) = self._idle.pop()
+
+				if time.time() - used < self._check_after or self.healthy(conn):
+					with self._lock:
+						self._reused += 1
+					return conn
+
+				self.discard(conn)
+
+			conn = self._connect()
+			with self._lock:
+				self._opened += 1
+			return conn
+
+		def healthy(self, conn):
+			try:
+				return self._check(conn)
+			except Exception:
+				return False
+
+		def discard(self, conn):
+			with self._lock:
+				self._discarded += 1
+
+			try:
+				conn.close()
+			except Exception:
+				pass
+
+		def close(self):
+			with self._lock:
+				idle = self._idle
+				self._idle = []
+
+			for conn, used in idle:
+				conn.close()
+
+		def metrics(self):
+			with self._lock:
+				return {
+					"idle": len(self._idle),
+					"opened": self._opened,
+					"reused": self._reused,
+					"discarded": self._discarded,
+				}
+
+	class RethinkBackend:
+		# Alongside the builds table, latest_builds holds the most recent
+		# build of each package, keyed by package. Both have an index on
+		# time_upload, so that recent builds are read from the front of an
+		# index rather than by grouping & sorting the whole history.
+		def __init__(self):
+			self._pool = DB.Pool(self.connect, self.check,
+					     Config.db_pool_size(), Config.db_pool_check_after())
+			self._prepared = False
+			self._prepare_lock = threading.Lock()
+
+		@property
+		def pool(self):
+			return self._pool
+
+		def connect(self):
+			conn = r.connect(Config.db_host(), Config.db_port())
+			conn.use(Config.db_name())
+			return conn
+
+		def check(self, conn):
+			return conn.is_open() and r.expr(1).run(conn) == 1
+
+		def prepare(self, conn):
+			# Creates latest_builds & the indexes if they don't yet exist,
+			# filling latest_builds from the existing history. Each step
+			# is checked for separately, so that should the daemon die part
+			# way through, the next one carries on from there. The meta
+			# table records that the history has been copied.
+			with self._prepare_lock:
+				if self._prepared:
+					return
+
+				tables = r.table_list().run(conn)
+				for table in ( "latest_builds", "meta" ):
+					if not table in tables:
+						key = "pkg" if table == "latest_builds" else "id"
+						r.table_create(table, primary_key=key).run(conn)
+
+				for table in ( "builds", "latest_builds" ):
+					if not "time_upload" in r.table(table).index_list().run(conn):
+						r.table(table).index_create("time_upload").run(conn)
+					r.table(table).index_wait("time_upload").run(conn)
+
+				if r.table("meta").get("latest_builds").run(conn) is None:
+					latest = r.table("builds").group("pkg").max("time_upload").ungroup()["reduction"]
+					DB.RethinkBackend.check_write("latest_builds",
+						r.table("latest_builds").insert(latest,
+							conflict=DB.RethinkBackend.keep_latest).run(conn))
+					r.table("meta").insert({ "id": "latest_builds", "filled": r.now() },
+						conflict="replace").run(conn)
+
+				self._prepared = True
+
+		def keep_latest(pkg, old, new):
+			return r.branch(new["time_upload"].gt(old["time_upload"]), new, old)
+
+		def recent_builds(self, n, show_all):
+			with self._pool.connection() as conn:
+				self.prepare(conn)
+
+				table = "builds" if show_all else "latest_builds"
+				q = r.table(table).order_by(index=r.desc("time_upload")).limit(n)
+
+				return list(q.run(conn))
+
+		def insert_builds(self, builds):
+			# Builds are replaced rather than duplicated, so that a batch
+			# which partly failed can be written again as a whole
+			with self._pool.connection() as conn:
+				self.prepare(conn)
+
+				result = r.table("builds").insert(builds, conflict="replace").run(conn)
+				latest = r.table("latest_builds").insert(builds,
+					conflict=DB.RethinkBackend.keep_latest).run(conn)
+
+			DB.RethinkBackend.check_write("builds", result)
+			DB.RethinkBackend.check_write("latest_builds", latest)
+
+			return result
+
+		def check_write(table, result):
+			# Failed writes are reported in the result rather than raised
+			if result.get("errors", 0) > 0:
+				raise Exception("Failed to write {0} builds to {1}: {2}".format(
+					result["errors"], table, result.get("first_error", "unknown error")))
+
+	class MemoryBackend:
+		# Keeps builds in memory, as the RethinkDB backend keeps them in its
+		# tables. Builds & the latest build of each package are held in
+		# lists sorted by (time_upload, insertion order), standing in for
+		# the time_upload indexes. Connections are simulated, each taking
+		# Config.db_memory_latency() seconds to open as a handshake with a
+		# server would, so that the pool has something to save.
+		class Connection:
+			def __init__(self):
+				self._open = True
+
+			def is_open(self):
+				return self._open
+
+			def close(self):
+				self._open = False
+
+		def __init__(self):
+			self._pool = DB.Pool(self.connect, self.check,
+					     Config.db_pool_size(), Config.db_pool_check_after())
+			self._lock = threading.Lock()
+			self._seq = 0
+
+			# entries are (time_upload, seq, build), seq making each unique
+			self._builds = []
+			self._latest = {}
+			self._latest_order = []
+
+		@property
+		def pool(self):
+			return self._pool
 
-			if not show_all:
-				q = q.group("pkg").max("time_upload").ungroup()["reduction"]
+		def connect(self):
+			time.sleep(Config.db_memory_latency())
+			return DB.MemoryBackend.Connection()
 
-			q = q.order_by(r.desc("time_upload")).limit(n)
+		def check(self, conn):
+			return conn.is_open()
 
-			return list(q.run(conn))
+		def recent_builds(self, n, show_all):
+			with self._pool.connection() as conn:
+				with self._lock:
+					index = self._builds if show_all else self._latest_order
+					top = index[max(0, len(index) - n):]
+
+			return [ dict(e[2]) for e in reversed(top) ]
+
+		def insert_builds(self, builds):
+			with self._pool.connection() as conn:
+				keys = []
+				with self._lock:
+					for b in builds:
+						b = dict(b)
+						if not "id" in b:
+							b["id"] = str(uuid.uuid4())
+							keys.append(b["id"])
+						self.insert(b)
+
+				return { "inserted": len(builds), "errors": 0, "generated_keys": keys }
+
+		def insert(self, build):
+			entry = (build["time_upload"], self._seq, build)
+			self._seq += 1
+
+			bisect.insort(self._builds, entry)
+
+			prev = self._latest.get(build["pkg"], None)
+			if prev is not None:
+				if prev[0] > entry[0]:
+					return
+				del self._latest_order[bisect.bisect_left(self._latest_order, prev)]
+
+			bisect.insort(self._latest_order, entry)
+			self._latest[build["pkg"]] = entry
+
+	class Writer:
+		# Inserts builds in the background, so that handling an upload
+		# needn't wait on the DB. Builds are buffered, up to
+		# Config.db_write_buffer() of them, & inserted in batches. A batch
+		# which fails is retried up to Config.db_write_retries() times,
+		# backing off between attempts, before being dropped.
+		_max_batch = 100
+
+		def __init__(self, backend):
+			self._backend = backend
+			self._queue = queue.Queue(Config.db_write_buffer())
+			self._lock = threading.Lock()
+			self._written = 0
+			self._retries = 0
+			self._dropped = 0
+
+			self._thread = threading.Thread(target=self.run, daemon=True)
+			self._thread.start()
+
+		def put(self, build):
+			try:
+				self._queue.put(build, timeout=Config.db_write_timeout())
+			except queue.Full:
+				raise Exception("DB write buffer full")
+
+		def flush(self, timeout):
+			# Waits for everything buffered to be written or dropped,
+			# returning whether it was
+			deadline = time.time() + timeout
+			while self._queue.unfinished_tasks > 0:
+				if time.time() >= deadline:
+					return False
+				time.sleep(0.05)
+			return True
+
+		def run(self):
+			while True:
+				batch = [ self._queue.get() ]
+				while len(batch) < DB.Writer._max_batch:
+					try:
+						batch.append(self._queue.get_nowait())
+					except queue.Empty:
+						break
+
+				self.write(batch)
+
+				for b in batch:
+					self._queue.task_done()
+
+		def write(self, batch):
+			retries = Config.db_write_retries()
+			delay = 0.1
+
+			for attempt in range(retries + 1):
+				try:
+					self._backend.insert_builds(batch)
+					with self._lock:
+						self._written += len(batch)
+					return
+				except Exception as ex:
+					print("Failed to write {0} builds ({1}), attempt {2} of {3}".format(
+						len(batch), ex, attempt + 1, retries + 1))
+
+				if attempt < retries:
+					with self._lock:
+						self._retries += 1
+					time.sleep(delay)
+					delay = min(delay * 2, 10)
+
+			print("Dropped builds: {0}".format(", ".join([ b["pkg"] for b in batch ])))
+			with self._lock:
+				self._dropped += len(batch)
+
+		def metrics(self):
+			with self._lock:
+				return {
+					"buffered": self._queue.qsize(),
+					"written": self._written,
+					"retries": self._retries,
+					"dropped": self._dropped,
+				}
+
+	_backends = {
+		"rethinkdb": RethinkBackend,
+		"memory": MemoryBackend,
+	}
+
+	def backend():
+		with DB._lock:
+			if DB._backend is None:
+				name = Config.db_backend()
+				if not name in DB._backends:
+					raise Exception("Unknown DB backend '{0}'".format(name))
+				DB._backend = DB._backends[name]()
+			return DB._backend
+
+	def writer():
+		backend = DB.backend()
+		with DB._lock:
+			if DB._writer is None:
+				DB._writer = DB.Writer(backend)
+			return DB._writer
+
+	def close(timeout=10):
+		# Writes out whatever's buffered, as far as possible within
+		# timeout, & closes idle connections. Should that time out, the
+		# writer is still using the pool, so it's left alone.
+		with DB._lock:
+			( backend, writer ) = ( DB._backend, DB._writer )
+
+		if writer is not None and not writer.flush(timeout):
+			print("Timed out writing buffered builds")
+			return
+		if backend is not None:
+			backend.pool.close()
+
+	def metrics():
+		with DB._lock:
+			( backend, writer ) = ( DB._backend, DB._writer )
+
+		return {
+			"backend": Config.db_backend(),
+			"pool": backend.pool.metrics() if backend is not None else None,
+			"writer": writer.metrics() if writer is not None else None,
+		}
+
+	def new_build(arch, pkg, version, status):
+		# Builds are given their ids here rather than by the DB, so that
+		# they're known before the build is written
+		return {
+			"id": str(uuid.uuid4()),
+			"arch": arch,
+			"pkg": pkg,
+			"version": version,
+			"status": status,
+			"time_upload": datetime.now(timezone.utc),
+		}
+
+	def recent_builds(n=10, show_all=False):
+		return DB.backend().recent_builds(n, show_all)
 
 	def insert_build(build):
-		with DB.connect() as conn:
-			return r.table("builds").insert(build).run(conn)
+		return DB.backend().insert_builds([ build ])
+
+	def insert_build_async(build):
+		DB.writer().put(build)
+
+	def benchmark(rows, pkgs=5000, n=10):
+		# Grows a history in the memory backend to rows builds, spread over
+		# pkgs packages, timing recent_builds as it goes & comparing it to
+		# grouping the whole history as before. Only the memory backend's
+		# stand-in for the time_upload indexes is timed, not RethinkDB.
+		print("Memory backend only: RethinkDB's indexes are not measured")
+		Config._json["db_memory_latency"] = 0
+		backend = DB.MemoryBackend()
+		start = datetime.now(timezone.utc)
+
+		size = 0
+		step = 1000
+		while size < rows:
+			count = min(step, rows - size)
+			backend.insert_builds([ {
+				"arch": "x86_64",
+				"pkg": "pkg{0}".format((size + i) * 7919 % pkgs),
+				"version": "1.0-1",
+				"status": "done",
+				"time_upload": start + timedelta(seconds=size + i),
+			} for i in range(count) ])
+			size += count
+
+			if size < step * 10 and size < rows:
+				continue
+			if size >= step * 10:
+				step *= 10
+
+			t = time.perf_counter()
+			for i in range(100):
+				recent = backend.recent_builds(n, False)
+			indexed = (time.perf_counter() - t) / 100
+
+			t = time.perf_counter()
+			latest = {}
+			for e in backend._builds:
+				b = e[2]
+				if not b["pkg"] in latest or b["time_upload"] > latest[b["pkg"]]["time_upload"]:
+					latest[b["pkg"]] = b
+			scan = sorted(latest.values(), key=lambda b: b["time_upload"], reverse=True)[:n]
+			grouped = time.perf_counter() - t
+
+			if [ b["id"] for b in recent ] != [ b["id"] for b in scan ]:
+				print("{0} rows: indexed & grouped results differ".format(size))
+				return False
+
+			print("{0:>9} rows: indexed {1:8.1f}us, grouped {2:8.1f}ms".format(
+				size, indexed * 1e6, grouped * 1e3))
+
+		return True
+
+if __name__ == "__main__":
+	sys.exit(0 if DB.benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000) else 1)
@@ -1,12 +1,28 @@
+import copy
 import os
-import shutil
 import tempfile
 
-from sh import repo_add
-
 from binaryrepo import BinaryRepo
+from config import Config
+from progress import Progress
+from repo import RepoChanges
+from repodb import RepoDB
+from utils import place_file
+from utils import slugify
 
 class DestRepo(BinaryRepo):
+	# Maps .PKGINFO keys to the DB fields BinaryRepo.BinPkg reads
+	_pkginfo_fields = {
+		"pkgname": "name",
+		"pkgbase": "base",
+		"pkgver": "version",
+		"pkgdesc": "desc",
+		"depend": "depends",
+		"makedepend": "makedepends",
+		"checkdepend": "checkdepends",
+		"group": "groups",
+	}
+
 	def __init__(self, name, path, arch):
 		self._arch = arch
 		BinaryRepo.__init__(self, name, path)
@@ -15,12 +31,28 @@ class DestRepo(BinaryRepo):
 		self._pkg_dir = os.path.join(path, "os", self._arch)
 		self._cache_db = os.path.join(self._pkg_dir, "{0}.db.tar.gz".format(self._name))
 		self._cache_src = None
+		self._cache_src_dir = None
+		self._repo_db = RepoDB(self._pkg_dir, self._name)
+
+		# Keep the snapshot out of the published repo directory
+		cache_dir = os.path.join(Config.cache_dir(), "dest")
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir, 0o755)
+		self._cache_snapshot = os.path.join(cache_dir,
+			"{0}.snapshot".format(slugify(self._cache_db)))
 
-	def download(self, url, filename):
-		raise Exception()
+	@property
+	def label(self):
+		return "{0} ({1})".format(self._name, self._arch)
 
-	def refresh(self):
-		self.read_packages()
+	def downloads(self):
+		return []
+
+	def refresh(self, progress=None):
+		old = self._pkgs
+		with Progress.track(progress, self.label, "parse"):
+			self.read_packages()
+			return self.diff_packages(old)
 
 	def _pkg_repo_path(self, src_path):
 		return os.path.join(self._pkg_dir, os.path.basename(src_path))
@@ -30,14 +62,106 @@ class DestRepo(BinaryRepo):
 			with tempfile.TemporaryDirectory() as td:
 				return self.add_packages(packages, tmp_dir=td)
 
+		# Each package's detached signature, if it has one, goes beside it
+		# in the repo, where the DB is read from
+		files = []
 		for src_path in packages:
+			files.append(src_path)
+			sig_path = "{0}.sig".format(src_path)
+			if os.path.exists(sig_path):
+				files.append(sig_path)
+
+		for src_path in files:
 			if os.path.exists(self._pkg_repo_path(src_path)):
 				raise Exception("package {0} already exists".format(
 					os.path.basename(src_path)))
 
-		for src_path in packages:
-			shutil.copyfile(src_path, self._pkg_repo_path(src_path))
+		# Packages are placed without copying where possible, & removed
+		# again should adding them to the DB fail, so nothing is left that
+		# the DB doesn't know about
+		placed = []
+
+		try:
+			for src_path in files:
+				dst_path = self._pkg_repo_path(src_path)
+				place_file(src_path, dst_path)
+				placed.append(dst_path)
+
+			self._repo_db.add([ self._pkg_repo_path(p) for p in packages ])
+		except:
+			for dst_path in placed:
+				os.unlink(dst_path)
+			raise
+
+		try:
+			return self.apply_packages([ self._pkg_repo_path(p) for p in packages ])
+		except Exception as ex:
+			print("Failed to read added packages ({0}), re-reading {1}".format(
+				ex, self._cache_db))
+			return self.refresh()
+
+	def apply_packages(self, paths):
+		# Updates the packages read from the DB just as the DB itself has
+		# been updated, from the .PKGINFO of each added package, rather
+		# than re-reading the whole DB. Packages already read are replaced
+		# rather than modified, as graphs may still be reading them.
+		# The DB's stamp is left alone, so the next refresh reads it again.
+		bases = {}
+		for path in paths:
+			fields = DestRepo.read_pkginfo(path)
+			if not "name" in fields or not "version" in fields:
+				raise Exception("Incomplete .PKGINFO in {0}".format(path))
+			base = fields.get("base", fields["name"])[0]
+			bases.setdefault(base, []).append(fields)
+
+		old = self._pkgs
+		self._pkgs = dict(old)
+
+		for base, new in bases.items():
+			prev = self._pkgs.pop(base, None)
+
+			for fields in new:
+				BinaryRepo.BinPkg(self, fields["name"][0], fields)
+
+			# Only packages of the same name are replaced in the DB, so any
+			# others built from the same source stay, along with the
+			# build dependencies they were read with
+			spkg = self._pkgs[base]
+			kept = [ b for b in prev.binaries if b.name not in spkg._pkgs ] if prev is not None else []
+			for b in kept:
+				b = copy.copy(b)
+				b._src = spkg
+				spkg._pkgs[b.name] = b
+
+			if len(kept) > 0:
+				spkg._makedeps |= prev._makedeps
+				spkg._checkdeps |= prev._checkdeps
+
+		added = [ b for b in bases if b not in old ]
+		changed = [ b for b in bases if b in old and
+			    old[b].signature() != self._pkgs[b].signature() ]
+
+		return RepoChanges(added=added, changed=changed)
+
+	def read_pkginfo(path):
+		# Reads the .PKGINFO of a package into fields as parse_fields
+		# would a DB entry. It's the first member of a package, so only
+		# the start of the package is decompressed.
+		data = None
+		for name, content in BinaryRepo.read_tar(path):
+			if name in ( ".PKGINFO", "./.PKGINFO" ):
+				data = content
+				break
+
+		if data is None:
+			raise Exception("No .PKGINFO in {0}".format(path))
 
-		repo_add(self._cache_db, packages)
+		fields = {}
+		for line in data.decode("utf-8").split("\n"):
+			( key, sep, value ) = line.partition(" = ")
+			if sep == "" or key.startswith("#"):
+				continue
+			if key in DestRepo._pkginfo_fields:
+				fields.setdefault(DestRepo._pkginfo_fields[key], []).append(value)
 
-		self.refresh()
+		return fields
@@ -0,0 +1,138 @@
+import json
+import os
+import requests
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+from requests.adapters import HTTPAdapter
+
+from config import Config
+
+class Downloader:
+	def __init__(self, workers=None, timeout=None, session=None):
+		self._workers = workers if workers is not None else Config.download_workers()
+		self._timeout = timeout if timeout is not None else Config.download_timeout()
+
+		if session is None:
+			session = requests.Session()
+			adapter = HTTPAdapter(pool_connections=self._workers,
+					      pool_maxsize=self._workers,
+					      max_retries=2)
+			session.mount("http://", adapter)
+			session.mount("https://", adapter)
+
+		self._session = session
+
+	class Result:
+		def __init__(self, url, filename):
+			self.url = url
+			self.filename = filename
+			self.started = None
+			self.modified = False
+			self.resumed = False
+			self.bytes = 0
+			self.seconds = 0.0
+			self.error = None
+
+		def __str__(self):
+			if self.error is not None:
+				return "{0}: failed: {1}".format(self.url, self.error)
+			if not self.modified:
+				return "{0}: not modified ({1:.2f}s)".format(self.url, self.seconds)
+			return "{0}: {1} bytes{2} in {3:.2f}s".format(
+				self.url, self.bytes, " (resumed)" if self.resumed else "",
+				self.seconds)
+
+	def fetch_all(self, files):
+		# Fetches each (url, filename) pair, up to self._workers at once.
+		# Returns a Result per file in the same order; failures are
+		# reported in Result.error rather than raised.
+		files = list(files)
+		if len(files) == 0:
+			return []
+
+		with ThreadPoolExecutor(max_workers=min(self._workers, len(files))) as pool:
+			results = list(pool.map(lambda f: self.fetch(*f), files))
+
+		for r in results:
+			print("Download {0}".format(r))
+
+		return results
+
+	def fetch(self, url, filename):
+		# Downloads url to filename if it has been modified since filename
+		# was last written. Data is written to filename.part & renamed into
+		# place once complete, so readers never see a partial file. An
+		# interrupted download is resumed from filename.part.
+		result = Downloader.Result(url, filename)
+		start = time.time()
+		result.started = start
+
+		try:
+			self._fetch(result)
+		except Exception as ex:
+			result.error = ex
+
+		result.seconds = time.time() - start
+		return result
+
+	def _fetch(self, result):
+		part = "{0}.part".format(result.filename)
+		meta = "{0}.part.meta".format(result.filename)
+
+		headers = {}
+		offset = 0
+		validator = None
+
+		if os.path.exists(part) and os.path.exists(meta):
+			with open(meta, "r") as fp:
+				validator = json.load(fp).get("validator", None)
+			offset = os.path.getsize(part)
+
+		if validator is not None and offset > 0:
+			# only resume if the file is still the one we started on
+			headers["Range"] = "bytes={0}-".format(offset)
+			headers["If-Range"] = validator
+		elif os.path.exists(result.filename):
+			mod = os.path.getmtime(result.filename)
+			headers["If-Modified-Since"] = formatdate(timeval=mod, usegmt=True)
+
+		with self._session.get(result.url, headers=headers, stream=True,
+				       timeout=self._timeout) as req:
+			if req.status_code == 304:
+				return
+
+			if req.status_code == 416:
+				# our partial file is no good, start again next time
+				Downloader._remove(part, meta)
+				raise Exception("range not satisfiable")
+
+			if req.status_code == 206:
+				result.resumed = True
+				mode = "ab"
+			elif req.status_code == 200:
+				offset = 0
+				mode = "wb"
+				validator = req.headers.get("ETag", req.headers.get("Last-Modified", None))
+				Downloader._remove(meta)
+				if validator is not None:
+					with open(meta, "w") as fp:
+						json.dump({ "validator": validator }, fp)
+			else:
+				raise Exception("HTTP status {0}".format(req.status_code))
+
+			with open(part, mode) as fp:
+				for chunk in req.iter_content(1 << 16):
+					fp.write(chunk)
+					result.bytes += len(chunk)
+
+		os.replace(part, result.filename)
+		Downloader._remove(meta)
+		result.modified = True
+
+	def _remove(*paths):
+		for path in paths:
+			if os.path.exists(path):
+				os.unlink(path)
@@ -0,0 +1,628 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+
+class Dynamic(Exception):
+	pass
+
+class FastParser:
+	# Bump whenever the output of the parser changes, so that cached
+	# results produced by an older version are discarded.
+	VERSION = 1
+
+	_path = os.path.realpath(__file__)
+
+	_assign_re = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)(\+?=)")
+	_func_re = re.compile(r"(?:function\s+)?([A-Za-z_][A-Za-z0-9_.:-]*)\s*\(\s*\)")
+	_func_kw_re = re.compile(r"function\s+([A-Za-z_][A-Za-z0-9_.:-]*)")
+	_name_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+	_heredoc_re = re.compile(r"<<(-?)\s*(['\"]?)([A-Za-z0-9_]+)\2")
+
+	# Variables which end up in the JSON output. If any of these cannot be
+	# determined statically the PKGBUILD must be handed to spkg-parse.sh.
+	_wanted = {
+		"arch",
+		"checkdepends",
+		"conflicts",
+		"depends",
+		"epoch",
+		"groups",
+		"license",
+		"makedepends",
+		"optdepends",
+		"pkgbase",
+		"pkgdesc",
+		"pkgname",
+		"pkgrel",
+		"pkgver",
+		"provides",
+		"replaces",
+		"url",
+	}
+
+	_DYNAMIC = object()
+
+	def __init__(self, text):
+		self._text = text
+		self._pos = 0
+		self._env = {
+			"CARCH": "mips32r2el",
+			"CHOST": "mipsel-unknown-linux-gnu",
+			"srcdir": "/pkg/src",
+			"depends": [],
+			"makedepends": [],
+			"checkdepends": [],
+			"provides": [],
+			"arch": [],
+		}
+
+	def parse_file(path):
+		# Returns the same JSON object as spkg-parse.sh would, or None if
+		# the PKGBUILD does anything which requires bash to evaluate.
+		try:
+			with open(path, "r", encoding="utf-8") as fp:
+				text = fp.read()
+		except (OSError, UnicodeDecodeError):
+			return None
+
+		try:
+			return FastParser(text).parse()
+		except Dynamic:
+			return None
+
+	def parse(self):
+		while self._skip_blank(newlines=True):
+			self._statement()
+
+		for name in FastParser._wanted:
+			if self._env.get(name, None) is FastParser._DYNAMIC:
+				raise Dynamic(name)
+
+		return self._to_json()
+
+	def _peek(self, n=1):
+		return self._text[self._pos:self._pos + n]
+
+	def _eof(self):
+		return self._pos >= len(self._text)
+
+	def _skip_blank(self, newlines=False):
+		# Skips whitespace, comments & line continuations, returning False
+		# at the end of the input.
+		while not self._eof():
+			c = self._peek()
+
+			if c in " \t":
+				self._pos += 1
+			elif self._peek(2) == "\\\n":
+				self._pos += 2
+			elif c == "#":
+				end = self._text.find("\n", self._pos)
+				self._pos = len(self._text) if end < 0 else end
+			elif newlines and c in "\n;":
+				self._pos += 1
+			else:
+				break
+
+		return not self._eof()
+
+	def _end_statement(self):
+		self._skip_blank()
+		if self._eof():
+			return
+		if self._peek() not in "\n;":
+			raise Dynamic("trailing text at offset {0}".format(self._pos))
+		self._pos += 1
+
+	def _statement(self):
+		m = FastParser._func_re.match(self._text, self._pos)
+		if m is None:
+			m = FastParser._func_kw_re.match(self._text, self._pos)
+		if m is not None:
+			self._function(m)
+			return
+
+		m = FastParser._assign_re.match(self._text, self._pos)
+		if m is None:
+			raise Dynamic("command at offset {0}".format(self._pos))
+
+		self._pos = m.end()
+		self._assignment(m.group(1), m.group(2) == "+=")
+		self._end_statement()
+
+	def _function(self, m):
+		name = m.group(1)
+
+		# package_*() functions are run for each split package and may
+		# override any of the variables we output
+		if name.startswith("package_"):
+			raise Dynamic("split package function {0}".format(name))
+
+		self._pos = m.end()
+		self._skip_blank(newlines=True)
+		if self._peek() != "{":
+			raise Dynamic("unsupported function body for {0}".format(name))
+
+		self._pos += 1
+		self._skip_braces()
+		self._end_statement()
+
+	def _assignment(self, name, append):
+		start = self._pos
+
+		try:
+			if self._peek() == "(":
+				self._pos += 1
+				value = self._array()
+			else:
+				value = self._word(array=False)
+		except Dynamic:
+			self._pos = start
+			self._skip_value()
+			self._env[name] = FastParser._DYNAMIC
+			return
+
+		if append:
+			prev = self._env.get(name, None)
+			if prev is FastParser._DYNAMIC:
+				return
+			if isinstance(value, list):
+				value = FastParser._as_array(prev) + value
+			else:
+				value = FastParser._as_scalar(prev) + value
+
+		self._env[name] = value
+
+	def _array(self):
+		values = []
+
+		while True:
+			if not self._skip_blank(newlines=True):
+				raise Dynamic("unterminated array")
+
+			if self._peek() == ")":
+				self._pos += 1
+				return values
+
+			values.extend(self._word(array=True))
+
+	def _word(self, array):
+		# Reads a single shell word. For arrays the result is a list of the
+		# fields it expands to, otherwise the string value it assigns.
+		fields = []
+		cur = None
+		start = self._pos
+
+		def add(s):
+			nonlocal cur
+			cur = s if cur is None else cur + s
+
+		def finish():
+			nonlocal cur
+			if cur is not None:
+				fields.append(cur)
+			cur = None
+
+		def add_split(s):
+			# unquoted expansions within arrays are split on whitespace
+			nonlocal cur
+			if not array:
+				add(s)
+				return
+			if s[:1].isspace():
+				finish()
+			parts = s.split()
+			for i, p in enumerate(parts):
+				if i > 0:
+					finish()
+				add(p)
+			if s[-1:].isspace():
+				finish()
+
+		while not self._eof():
+			c = self._peek()
+
+			if c in " \t\n;":
+				break
+			if c == ")" and array:
+				break
+
+			if c == "'":
+				end = self._text.find("'", self._pos + 1)
+				if end < 0:
+					raise Dynamic("unterminated quote")
+				add(self._text[self._pos + 1:end])
+				self._pos = end + 1
+			elif c == '"':
+				self._pos += 1
+				self._double_quoted(add, fields, finish, array)
+			elif c == "\\":
+				if self._peek(2) == "\\\n":
+					self._pos += 2
+				else:
+					add(self._text[self._pos + 1:self._pos + 2])
+					self._pos += 2
+			elif c == "$":
+				if self._peek(2) == "$'":
+					raise Dynamic("ANSI-C quoting")
+				value = self._expansion()
+				if isinstance(value, list):
+					if not array:
+						add(" ".join(value))
+					else:
+						for v in value:
+							add_split(" {0} ".format(v))
+				else:
+					add_split(value)
+			elif c in "`|&<>(*?[{":
+				raise Dynamic("unsupported syntax '{0}'".format(c))
+			elif c == "~" and self._pos == start:
+				raise Dynamic("tilde expansion")
+			else:
+				add(c)
+				self._pos += 1
+
+		finish()
+
+		if array:
+			return fields
+		return fields[0] if len(fields) > 0 else ""
+
+	def _double_quoted(self, add, fields, finish, array):
+		# "${arr[@]}" of an empty array is the only quoted word which
+		# expands to no fields at all
+		empty_array = False
+		start = self._pos
+
+		while True:
+			if self._eof():
+				raise Dynamic("unterminated quote")
+
+			c = self._peek()
+
+			if c == '"':
+				self._pos += 1
+				if not empty_array:
+					add("")
+				return
+
+			if c == "\\":
+				n = self._text[self._pos + 1:self._pos + 2]
+				if n == "\n":
+					pass
+				elif n in '$`"\\':
+					add(n)
+				else:
+					add(c + n)
+				self._pos += 2
+			elif c == "`":
+				raise Dynamic("command substitution")
+			elif c == "$":
+				value = self._expansion()
+				if isinstance(value, list):
+					# "${arr[@]}" expands to one field per element
+					if not array:
+						add(" ".join(value))
+					elif len(value) == 0:
+						empty_array = self._peek() == '"' and \
+							self._text[start:self._pos].startswith("${")
+					else:
+						add(value[0])
+						for v in value[1:]:
+							finish()
+							add(v)
+				else:
+					add(value)
+			else:
+				add(c)
+				self._pos += 1
+
+	def _expansion(self):
+		# Evaluates the $... expansion at the current position. Arrays
+		# expanded with [@] or [*] are returned as lists.
+		self._pos += 1
+		c = self._peek()
+
+		if c == "(":
+			raise Dynamic("command substitution")
+
+		if c == "{":
+			end = self._text.find("}", self._pos)
+			if end < 0:
+				raise Dynamic("unterminated expansion")
+			expr = self._text[self._pos + 1:end]
+			self._pos = end + 1
+
+			m = re.fullmatch(r"([A-Za-z_][A-Za-z0-9_]*)(?:\[([@*]|[0-9]+)\])?", expr)
+			if m is None:
+				raise Dynamic("parameter expansion ${{{0}}}".format(expr))
+
+			value = self._lookup(m.group(1))
+			index = m.group(2)
+			if index is None:
+				return FastParser._as_scalar(value)
+			if index in "@*":
+				return FastParser._as_array(value)
+
+			array = FastParser._as_array(value)
+			index = int(index)
+			return array[index] if index < len(array) else ""
+
+		m = FastParser._name_re.match(self._text, self._pos)
+		if m is None:
+			if c == "" or c in " \t\n":
+				return "$"
+			raise Dynamic("special parameter ${0}".format(c))
+
+		self._pos = m.end()
+		return FastParser._as_scalar(self._lookup(m.group(0)))
+
+	def _lookup(self, name):
+		if name not in self._env:
+			# may come from the environment bash runs in
+			raise Dynamic("unknown variable {0}".format(name))
+
+		value = self._env[name]
+		if value is FastParser._DYNAMIC:
+			raise Dynamic("dynamic variable {0}".format(name))
+
+		return value
+
+	def _skip_quoted(self):
+		c = self._peek()
+
+		if c == "'":
+			end = self._text.find("'", self._pos + 1)
+		elif c == "`":
+			end = self._text.find("`", self._pos + 1)
+		else:
+			end = self._pos + 1
+			while end < len(self._text) and self._text[end] != '"':
+				end += 2 if self._text[end] == "\\" else 1
+
+		if end < 0 or end >= len(self._text):
+			raise Dynamic("unterminated quote")
+
+		self._pos = end + 1
+
+	def _skip_value(self):
+		# Skips an assignment value which could not be evaluated, leaving
+		# the position at the end of the statement.
+		depth = 0
+
+		while not self._eof():
+			c = self._peek()
+
+			if c in "'\"`":
+				self._skip_quoted()
+				continue
+
+			if c == "\\":
+				self._pos += 2
+				continue
+
+			if c == "#" and depth > 0 and self._text[self._pos - 1] in " \t\n(":
+				self._skip_blank()
+				continue
+
+			if c in "({":
+				depth += 1
+			elif c in ")}":
+				depth -= 1
+			elif depth == 0 and c in " \t\n;":
+				return
+
+			self._pos += 1
+
+		if depth != 0:
+			raise Dynamic("unbalanced value")
+
+	def _skip_braces(self):
+		# Skips the body of a function, up to and including the closing
+		# brace. Braces within quotes, comments & here documents are ignored.
+		depth = 1
+		heredocs = []
+
+		while depth > 0:
+			if self._eof():
+				raise Dynamic("unterminated function")
+
+			c = self._peek()
+
+			if c in "'\"`":
+				self._skip_quoted()
+				continue
+
+			if c == "\\":
+				self._pos += 2
+				continue
+
+			if c == "#" and self._text[self._pos - 1] in " \t\n;(":
+				self._skip_blank()
+				continue
+
+			if c == "<":
+				m = FastParser._heredoc_re.match(self._text, self._pos)
+				if m is not None and self._peek(3) != "<<<":
+					heredocs.append((m.group(1) == "-", m.group(3)))
+					self._pos = m.end()
+					continue
+
+			if c == "\n" and len(heredocs) > 0:
+				self._pos += 1
+				for strip_tabs, delim in heredocs:
+					self._skip_heredoc(strip_tabs, delim)
+				heredocs = []
+				continue
+
+			if c == "{":
+				depth += 1
+			elif c == "}":
+				depth -= 1
+
+			self._pos += 1
+
+	def _skip_heredoc(self, strip_tabs, delim):
+		while not self._eof():
+			end = self._text.find("\n", self._pos)
+			if end < 0:
+				end = len(self._text)
+
+			line = self._text[self._pos:end]
+			self._pos = end + 1
+
+			if strip_tabs:
+				line = line.lstrip("\t")
+			if line == delim:
+				return
+
+		raise Dynamic("unterminated here document {0}".format(delim))
+
+	def _as_scalar(value):
+		if value is None:
+			return ""
+		if isinstance(value, list):
+			return value[0] if len(value) > 0 else ""
+		return value
+
+	def _as_array(value):
+		if value is None:
+			return []
+		if isinstance(value, list):
+			return value
+		return [value]
+
+	def _split(values):
+		# Mirrors the ($(echo ${arr[@]})) re-splitting done by spkg-parse.sh
+		fields = []
+		for v in values:
+			if any(c in v for c in "*?["):
+				raise Dynamic("glob in '{0}'".format(v))
+			fields.extend(v.split())
+		return fields
+
+	def _escape(s):
+		# escape_json in spkg-parse.sh flattens line breaks
+		return s.replace("\n", " ").replace("\r", " ")
+
+	def _to_json(self):
+		env = self._env
+		scalar = lambda n: FastParser._as_scalar(env.get(n, None))
+		array = lambda n: FastParser._as_array(env.get(n, None))
+
+		out = {}
+
+		if scalar("pkgbase") != "":
+			out["base"] = scalar("pkgbase")
+		out["ver"] = scalar("pkgver")
+		out["rel"] = scalar("pkgrel")
+		if scalar("epoch") != "":
+			out["epoch"] = scalar("epoch")
+
+		for key in ("license", "url"):
+			value = FastParser._escape(scalar(key))
+			if value != "":
+				out[key] = value
+
+		makedeps = FastParser._split(array("depends") + array("makedepends"))
+		if len(makedeps) > 0:
+			out["makedepends"] = makedeps
+
+		if len(array("checkdepends")) > 0:
+			out["checkdepends"] = FastParser._split(array("checkdepends"))
+
+		pkg_vars = {
+			"depends": array("depends"),
+			"optdepends": array("optdepends"),
+			"provides": array("provides"),
+			"conflicts": array("conflicts"),
+			"replaces": array("replaces"),
+		}
+		desc = scalar("pkgdesc")
+
+		out["packages"] = []
+		for name in FastParser._split(array("pkgname")):
+			pkg = { "name": FastParser._escape(name) }
+
+			if len(array("arch")) > 0:
+				pkg["arch"] = FastParser._split(array("arch"))
+
+			for key in ("depends", "optdepends", "provides", "conflicts", "replaces"):
+				if len(pkg_vars[key]) == 0:
+					continue
+				if key == "optdepends":
+					pkg[key] = [ FastParser._escape(v) for v in pkg_vars[key] ]
+				else:
+					pkg[key] = FastParser._split(pkg_vars[key])
+
+			if len(array("groups")) > 0:
+				pkg["groups"] = FastParser._split(array("groups"))
+
+			pkg["desc"] = FastParser._escape(desc)
+			out["packages"].append(pkg)
+
+			# spkg-parse.sh resets these after each package
+			pkg_vars = { k: [] for k in pkg_vars }
+			desc = ""
+
+		return out
+
+	def verify(tree):
+		# Parses every package in tree with both the fast path & bash,
+		# reporting any differences. Returns the number of mismatches.
+		from sourcerepo import SourceRepo
+
+		pkgbuilds = {}
+		fast = {}
+
+		for dir_name in sorted(os.listdir(tree)):
+			pkgbuild = os.path.join(tree, dir_name, "PKGBUILD")
+			if dir_name.startswith(".") or not os.path.exists(pkgbuild):
+				continue
+
+			pkgbuilds[dir_name] = pkgbuild
+			result = FastParser.parse_file(pkgbuild)
+			if result is not None:
+				fast[dir_name] = result
+
+		print("Fast path handles {0} of {1} packages".format(
+			len(fast), len(pkgbuilds)))
+
+		mismatches = 0
+		checked = { k: pkgbuilds[k] for k in fast }
+		for dir_name, pkg_json in SourceRepo.parse_pkgbuilds(checked, fast=False):
+			if isinstance(pkg_json, Exception):
+				print("{0}: bash failed: {1}".format(dir_name, pkg_json))
+				mismatches += 1
+				continue
+
+			if pkg_json == fast[dir_name]:
+				continue
+
+			mismatches += 1
+			print("{0}: mismatch".format(dir_name))
+			print("  bash: {0}".format(pkg_json))
+			print("  fast: {0}".format(fast[dir_name]))
+
+		print("{0} mismatches".format(mismatches))
+		return mismatches
+
+if __name__ == "__main__":
+	from config import Config
+
+	parser = argparse.ArgumentParser(
+		description="Compare the fast PKGBUILD parser against spkg-parse.sh")
+	parser.add_argument(
+		"--config",
+		dest="config",
+		default="architect.conf",
+		help="use the specified config file"
+	)
+	parser.add_argument("tree", type=str, help="Directory of package directories")
+	args = parser.parse_args()
+
+	Config.load(args.config)
+	sys.exit(1 if FastParser.verify(args.tree) else 0)
@@ -2,6 +2,8 @@ import os
 import subprocess
 
 from config import Config
+from progress import Progress
+from repo import RepoChanges
 from sourcerepo import SourceRepo
 from utils import slugify
 
@@ -12,13 +14,23 @@ class GitSourceRepo(SourceRepo):
 
 		cache_dir = os.path.join(Config.cache_dir(), slugify(url))
 		self._repo = os.path.join(cache_dir, "repo")
-		self._cache = os.path.join(cache_dir, "cache")
-		if not os.path.isdir(self._cache):
-			os.makedirs(self._cache, 0o755)
+		self._cache = os.path.join(cache_dir, "sources.sqlite")
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir, 0o755)
+
+		# The commit the packages in self._pkgs were last read from, & the
+		# one fetch() last pulled
+		self._head = None
+		self._fetched = None
 
 		if os.path.exists(self._repo):
+			self._head = self.git_head()
 			self.read_sources()
 
+	@property
+	def label(self):
+		return "{0} (git)".format(self._name)
+
 	def git_clone(self):
 		print("Clone {0}".format(self._url))
 
@@ -48,10 +60,54 @@ class GitSourceRepo(SourceRepo):
 		if pgit.returncode != 0:
 			raise Exception("git returned {0}".format(pgit.returncode))
 
-	def refresh(self):
-		if os.path.exists(self._repo):
-			self.git_update()
-		else:
-			self.git_clone()
+	def git_output(self, args):
+		pgit = subprocess.Popen(["git"] + args, cwd=self._repo,
+					stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		sout, serr = pgit.communicate()
+
+		if pgit.returncode != 0:
+			raise Exception("git returned {0}".format(pgit.returncode))
+
+		return sout.decode("utf-8")
+
+	def git_head(self):
+		return self.git_output(["rev-parse", "HEAD"]).strip()
+
+	def git_changed_dirs(self, old, new):
+		# The top-level package directories touched between two commits.
+		# Renames are listed as a deletion plus an addition so that both
+		# directories are picked up.
+		out = self.git_output(["diff", "--name-only", "--no-renames", "-z",
+				       old, new])
+
+		return set([ p.split("/", 1)[0] for p in out.split("\0") if "/" in p ])
+
+	def fetch(self, progress=None):
+		# Pulls the checkout, leaving the packages read from it alone
+		# until refresh
+		with Progress.track(progress, self.label, "git"):
+			if os.path.exists(self._repo):
+				self.git_update()
+			else:
+				self.git_clone()
+
+			self._fetched = self.git_head()
+
+	def refresh(self, progress=None):
+		if self._fetched is None:
+			self.fetch(progress)
+
+		head = self._fetched
+		self._fetched = None
+
+		with Progress.track(progress, self.label, "parse"):
+			if self._head is None:
+				changes = self.read_sources()
+			elif head == self._head:
+				changes = RepoChanges()
+			else:
+				changes = self.read_sources(self.git_changed_dirs(self._head, head))
 
-		self.read_sources()
+		self._head = head
+		print("Refreshed {0}: {1}".format(self._repo, changes))
+		return changes
@@ -0,0 +1,165 @@
+import threading
+import time
+
+from config import Config
+
+class IngestQueue:
+	# Adds received packages to one architecture's destination repo. Each
+	# addition rewrites the whole DB, so uploads arriving within
+	# Config.ingest_window() seconds of each other are added together. If
+	# that fails each upload is retried alone, so that one bad package
+	# only fails the client which sent it.
+
+	# How often, in seconds, the queue checks whether we're exiting
+	_poll_interval = 0.5
+
+	class Upload:
+		def __init__(self, packages):
+			self.packages = packages
+			self.error = None
+			self._done = threading.Event()
+
+		def finish(self, error=None):
+			self.error = error
+			self._done.set()
+
+		def wait(self):
+			self._done.wait()
+			if self.error is not None:
+				raise self.error
+
+	def __init__(self, daemon, arch, repo):
+		self._daemon = daemon
+		self._arch = arch
+		self._repo = repo
+		self._cond = threading.Condition()
+		self._pending = []
+		self._thread = None
+
+		self._adding = 0
+		self._batches = 0
+		self._uploads = 0
+		self._retries = 0
+		self._failed = 0
+		self._max_batch = 0
+		self._last_batch = 0
+		self._last_seconds = 0.0
+
+	def add(self, packages):
+		# Blocks until the packages have been added, raising if they
+		# couldn't be
+		upload = IngestQueue.Upload(packages)
+
+		with self._cond:
+			if self._daemon._exit:
+				raise Exception("daemon is exiting")
+
+			if self._thread is None:
+				self._thread = threading.Thread(target=self.run, daemon=True)
+				self._thread.start()
+
+			self._pending.append(upload)
+			self._cond.notify()
+
+		upload.wait()
+
+	def metrics(self):
+		with self._cond:
+			return {
+				"arch": self._arch,
+				"repo": self._repo,
+				"depth": len(self._pending),
+				"adding": self._adding,
+				"batches": self._batches,
+				"uploads": self._uploads,
+				"retries": self._retries,
+				"failed": self._failed,
+				"max_batch": self._max_batch,
+				"mean_batch": self._uploads / self._batches if self._batches > 0 else 0,
+				"last_batch": self._last_batch,
+				"last_batch_seconds": self._last_seconds,
+			}
+
+	def take(self):
+		# Waits for an upload, then for the window to pass or the batch to
+		# fill, returning everything queued by then
+		window = Config.ingest_window()
+		limit = Config.ingest_batch()
+
+		with self._cond:
+			while len(self._pending) == 0:
+				if self._daemon._exit:
+					return []
+				self._cond.wait(IngestQueue._poll_interval)
+
+			deadline = time.time() + window
+			while len(self._pending) < limit:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self._cond.wait(remaining)
+
+			batch = self._pending[:limit]
+			self._pending = self._pending[limit:]
+			self._adding = len(batch)
+			return batch
+
+	def run(self):
+		while not self._daemon._exit:
+			batch = self.take()
+			if len(batch) == 0:
+				continue
+
+			start = time.time()
+			print("Ingesting {0} upload{1} into {2}/{3}".format(
+				len(batch), "" if len(batch) == 1 else "s", self._repo, self._arch))
+
+			try:
+				self.apply([ p for u in batch for p in u.packages ])
+				for u in batch:
+					u.finish()
+			except Exception as ex:
+				if len(batch) == 1:
+					batch[0].finish(ex)
+				else:
+					print("Batch failed ({0}), retrying uploads individually".format(ex))
+					self.retry(batch)
+
+			with self._cond:
+				self._adding = 0
+				self._batches += 1
+				self._uploads += len(batch)
+				self._max_batch = max(self._max_batch, len(batch))
+				self._last_batch = len(batch)
+				self._last_seconds = time.time() - start
+				self._failed += len([ u for u in batch if u.error is not None ])
+
+		# Anything queued whilst the last batch was added would otherwise
+		# wait forever
+		with self._cond:
+			pending = self._pending
+			self._pending = []
+
+		for u in pending:
+			u.finish(Exception("daemon is exiting"))
+
+	def retry(self, batch):
+		for u in batch:
+			with self._cond:
+				self._retries += 1
+
+			try:
+				self.apply(u.packages)
+				u.finish()
+			except Exception as ex:
+				u.finish(ex)
+
+	def apply(self, packages):
+		def ingest(graphs):
+			pg = graphs[self._arch]
+			repo = [ r for r in pg.repos if r.name == self._repo ][0]
+
+			changes = repo._dst.add_packages(packages)
+			pg.apply_changes(repo.update_lists(changes.names))
+
+		self._daemon.mutate(ingest)
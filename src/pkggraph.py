@@ -1,7 +1,7 @@
-from binaryrepo import BinaryRepo
 from config import Config
 from destrepo import DestRepo
-from gitsourcerepo import GitSourceRepo
+from progress import Progress
+from upstream import Upstreams
 
 class PkgGraph:
 	class Pkg:
@@ -79,6 +79,48 @@ class PkgGraph:
 				return None
 			return self._spkgs[0].version
 
+		def build_deps(self):
+			# Everything this package needs to build
+			for kind, dep in self.typed_build_deps():
+				yield dep
+
+		def typed_build_deps(self):
+			src = self.source
+			if src is None:
+				return
+
+			for dep in src.makedepends:
+				yield ("makedepends", dep)
+			for dep in src.checkdepends:
+				yield ("checkdepends", dep)
+			for bpkg in src.binaries:
+				for dep in bpkg.depends:
+					yield ("depends", dep)
+
+		def dep_names(self):
+			return set([ dep.name for dep in self.build_deps() ])
+
+		def will_provide(self):
+			# The names this package will provide once its source is built
+			provides = {}
+			for bpkg in self.source.binaries:
+				provides[bpkg.name] = self.source.version
+				provides.update(bpkg.provides)
+
+			return provides
+
+		def provided(self):
+			# The names this package satisfies dependencies on, if any
+			if not self.up_to_date:
+				return {}
+
+			provides = {}
+			for bpkg in self._dpkg.binaries:
+				provides[bpkg.name] = bpkg.version
+				provides.update(bpkg.provides)
+
+			return provides
+
 		def ready_for_build(self, up_to_date):
 			if self.excluded:
 				return False
@@ -113,46 +155,76 @@ class PkgGraph:
 			self._graph = graph
 			self._name = cfg["name"]
 
-			self._src = []
-			for c in cfg["src"]:
-				if "binary" in c:
-					self._src.append(BinaryRepo(self._name, c["binary"]))
-				elif "source-git" in c:
-					self._src.append(GitSourceRepo(self._name, c["source-git"]))
-				else:
-					raise Exception("unknown repo type: {0}".format(c))
+			self._src = [ graph._upstreams.get(self._name, c) for c in cfg["src"] ]
 
 			self._dst = DestRepo(self._name, cfg["dst"], graph._arch)
 
 			self.gen_lists()
 
-		def refresh(self):
+		def clone(self, graph):
+			r = object.__new__(PkgGraph.Repo)
+			r._graph = graph
+			r._name = self._name
+			r._src = self._src
+			r._dst = self._dst
+			r._pkgs = dict(self._pkgs)
+			return r
+
+		def refresh(self, changes, progress=None):
+			# The upstream repos have already been refreshed, with their
+			# RepoChanges in changes
+			names = set()
 			for s in self._src:
-				s.refresh()
+				names |= Upstreams.changes_for(changes, s).names
+			names |= self._dst.unapplied(self._dst.refresh(progress)).names
 
-			self._dst.refresh()
-			self.gen_lists()
+			return self.update_lists(names)
 
 		def gen_lists(self):
 			self._pkgs = {}
 
+			names = {}
 			for src in self._src:
-				for spkg in src.packages:
-					p = self._pkgs.get(spkg.name, None)
-					if p is None:
-						p = PkgGraph.Pkg(spkg.id)
-						self._pkgs[spkg.name] = p
+				names.update(dict.fromkeys(src._pkgs))
+			names.update(dict.fromkeys(self._dst._pkgs))
+
+			self.update_lists(names)
+
+		def update_lists(self, names):
+			# Rebuild the named packages from scratch, leaving all others
+			# alone. Returns (old, new) pairs for each package affected,
+			# either of which may be None.
+			changes = []
+
+			for name in names:
+				old = self._pkgs.pop(name, None)
+				new = self.gen_pkg(name)
+				if new is not None:
+					self._pkgs[name] = new
+				if old is not None or new is not None:
+					changes.append((old, new))
+
+			return changes
+
+		def gen_pkg(self, name):
+			p = None
 
-					p._spkgs.append(spkg)
+			for src in self._src:
+				spkg = src._pkgs.get(name, None)
+				if spkg is None:
+					continue
+				if p is None:
+					p = PkgGraph.Pkg(spkg.id)
+				p._spkgs.append(spkg)
 
-			for dpkg in self._dst.packages:
-				p = self._pkgs.get(dpkg.name, None)
+			dpkg = self._dst._pkgs.get(name, None)
+			if dpkg is not None:
 				if p is None:
 					p = PkgGraph.Pkg(dpkg.id)
-					self._pkgs[dpkg.name] = p
-
 				p._dpkg = dpkg
 
+			return p
+
 		@property
 		def name(self):
 			return self._name
@@ -183,8 +255,16 @@ class PkgGraph:
 				if (not p.built) or p.out_of_date:
 					yield p
 
-	def __init__(self, arch):
+	class Plan:
+		def __init__(self, generation):
+			self.generation = generation
+			self.waves = []
+			self.blocked = []
+			self.cyclic = []
+
+	def __init__(self, arch, upstreams=None):
 		self._arch = arch
+		self._upstreams = upstreams if upstreams is not None else Upstreams()
 		self.repos = [ PkgGraph.Repo(self, c) for c in Config.repos() ]
 		self.gen_graph()
 
@@ -196,30 +276,324 @@ class PkgGraph:
 	def packages(self):
 		return self._pkgs.values()
 
-	def refresh(self):
+	def clone(self):
+		# Returns a copy of the graph which can be modified without
+		# affecting this one. Packages are replaced rather than modified,
+		# so only the containers holding them need copying.
+		g = object.__new__(PkgGraph)
+		g._arch = self._arch
+		g._upstreams = self._upstreams
+		g.repos = [ repo.clone(g) for repo in self.repos ]
+		g._pkgs = dict(self._pkgs)
+		g._up_to_date = dict(self._up_to_date)
+		g._providers = dict([ (name, dict(p)) for name, p in self._providers.items() ])
+		g._rdeps = dict([ (name, set(r)) for name, r in self._rdeps.items() ])
+		g._ready = dict(self._ready)
+		g._generation = self._generation
+		g._plan = self._plan
+		return g
+
+	def refresh(self, upstream_changes=None, progress=None):
+		# When the upstreams are shared with other graphs the caller
+		# refreshes them once, passing in the result, & refreshes each
+		# graph with it. The caller then calls applied() on the upstreams
+		# & graphs once the graphs it refreshed are in use.
+		standalone = upstream_changes is None
+		if standalone:
+			self._upstreams.fetch(progress)
+			upstream_changes = self._upstreams.refresh(progress)
+
+		with Progress.track(progress, self._arch, "graph"):
+			changes = []
+			for repo in self.repos:
+				changes.extend(repo.refresh(upstream_changes, progress))
+
+			self.apply_changes(changes)
+
+		if standalone:
+			self._upstreams.applied()
+			self.applied()
+
+		return changes
+
+	def applied(self):
 		for repo in self.repos:
-			repo.refresh()
-		self.gen_graph()
+			repo._dst.applied()
 
 	def gen_graph(self):
 		self._pkgs = {}
 		self._up_to_date = {}
+		self._providers = {}
+		self._rdeps = {}
+		self._ready = {}
+		self._generation = 0
+		self._plan = None
+
+		self.apply_changes([ (None, pkg) for repo in self.repos for pkg in repo.packages ])
+
+	def apply_changes(self, changes):
+		# Patch the graph with (old, new) package pairs as returned by
+		# PkgGraph.Repo.update_lists. _providers tracks every up to date
+		# package providing a name so that _up_to_date can be recomputed
+		# for just the names whose providers changed. Likewise _rdeps maps
+		# each dependency name to the packages needing it, so that _ready
+		# need only be re-checked for new packages & the dependents of
+		# touched names.
+		touched = set()
+		dirty = set()
+
+		if len(changes) > 0:
+			self._generation += 1
+
+		for old, new in changes:
+			if old is not None:
+				del self._pkgs[old.id]
+				self._ready.pop(old.id, None)
+				for name in old.dep_names():
+					rdeps = self._rdeps[name]
+					rdeps.discard(old.id)
+					if len(rdeps) == 0:
+						del self._rdeps[name]
+				for name in old.provided():
+					providers = self._providers[name]
+					del providers[old.id]
+					if len(providers) == 0:
+						del self._providers[name]
+					touched.add(name)
+
+			if new is not None:
+				self._pkgs[new.id] = new
+				dirty.add(new.id)
+				for name in new.dep_names():
+					self._rdeps.setdefault(name, set()).add(new.id)
+				for name, ver in new.provided().items():
+					self._providers.setdefault(name, {})[new.id] = ver
+					touched.add(name)
+
+		for name in touched:
+			dirty.update(self._rdeps.get(name, ()))
+
+			providers = self._providers.get(name, None)
+			if providers is None:
+				self._up_to_date.pop(name, None)
+				continue
 
-		for repo in self.repos:
-			for pkg in repo.packages:
-				self._pkgs[pkg.id] = pkg
+			best = None
+			for ver in providers.values():
+				if best is None or ver > best:
+					best = ver
+			self._up_to_date[name] = best
 
-		for pkg in self._pkgs.values():
-			if not pkg.up_to_date:
-				continue
-			dpkg = pkg._dpkg
-			if dpkg is None:
+		for pkg_id in dirty:
+			pkg = self._pkgs.get(pkg_id, None)
+			if pkg is None:
 				continue
-			for bpkg in dpkg.binaries:
-				self._up_to_date[bpkg.name] = bpkg.version
-				self._up_to_date.update(bpkg.provides)
+			if pkg.ready_for_build(self._up_to_date):
+				self._ready[pkg_id] = pkg
+			else:
+				self._ready.pop(pkg_id, None)
+
+		return touched
 
 	def ready_for_build(self):
-		for pkg in self._pkgs.values():
-			if pkg.ready_for_build(self._up_to_date):
-				yield pkg
+		return list(self._ready.values())
+
+	def pending(self):
+		# Packages which require a build that we're able to attempt
+		pending = {}
+		for repo in self.repos:
+			for p in repo.build_required:
+				if p.source is not None and not p.excluded:
+					pending[p.id] = p
+
+		return pending
+
+	def pending_providers(self, pending):
+		# Maps names to the pending packages that will provide them, as
+		# (id, version) pairs in id order
+		providers = {}
+		for p in sorted(pending.values(), key=lambda p: p.id):
+			for name, ver in p.will_provide().items():
+				providers.setdefault(name, []).append((p.id, ver))
+
+		return providers
+
+	def build_plan(self):
+		if self._plan is None or self._plan.generation != self._generation:
+			self._plan = self.gen_plan()
+		return self._plan
+
+	def gen_plan(self):
+		# Orders every package requiring a build into waves, each of which
+		# only depends upon packages that are up to date or built in an
+		# earlier wave. Packages which can never be built from what we
+		# have are reported as blocked, along with the reasons why.
+		plan = PkgGraph.Plan(self._generation)
+		pending = self.pending()
+		providers = self.pending_providers(pending)
+
+		waits = {}
+		blocked = {}
+
+		for p in pending.values():
+			if p.source_outdated:
+				blocked[p.id] = [ "newer upstream source" ]
+				continue
+
+			waits[p.id] = set()
+			missing = set()
+
+			for dep in p.build_deps():
+				if dep.met(self._up_to_date):
+					continue
+
+				# wait for the first pending package providing the dep
+				for pkg_id, ver in providers.get(dep.name, ()):
+					if pkg_id != p.id and dep.met({ dep.name: ver }):
+						waits[p.id].add(pkg_id)
+						break
+				else:
+					missing.add(dep.name)
+
+			if len(missing) > 0:
+				blocked[p.id] = [ "missing {0}".format(m) for m in sorted(missing) ]
+
+		# anything waiting on a blocked package is blocked too
+		changed = True
+		while changed:
+			changed = False
+			for pkg_id, w in waits.items():
+				if pkg_id in blocked:
+					continue
+				bad = sorted(w & blocked.keys())
+				if len(bad) > 0:
+					blocked[pkg_id] = [ "waits on {0}".format(b) for b in bad ]
+					changed = True
+
+		planned = [ pkg_id for pkg_id in waits if pkg_id not in blocked ]
+		dependents = dict([ (pkg_id, []) for pkg_id in planned ])
+		count = {}
+
+		for pkg_id in planned:
+			count[pkg_id] = len(waits[pkg_id])
+			for w in waits[pkg_id]:
+				dependents[w].append(pkg_id)
+
+		order = []
+		wave = [ pkg_id for pkg_id in planned if count[pkg_id] == 0 ]
+		while len(wave) > 0:
+			plan.waves.append(wave)
+			order.extend(wave)
+
+			next_wave = []
+			for pkg_id in wave:
+				for d in dependents[pkg_id]:
+					count[d] -= 1
+					if count[d] == 0:
+						next_wave.append(d)
+			wave = next_wave
+
+		# Priority is the number of packages transitively waiting on each
+		# package, found by OR-ing bitsets of dependents in reverse order
+		bit = dict([ (pkg_id, 1 << i) for i, pkg_id in enumerate(order) ])
+		reach = {}
+		for pkg_id in reversed(order):
+			r = 0
+			for d in dependents[pkg_id]:
+				if d in reach:
+					r |= reach[d] | bit[d]
+			reach[pkg_id] = r
+
+		plan.waves = [ sorted([ (pending[pkg_id], bin(reach[pkg_id]).count("1")) for pkg_id in wave ],
+				      key=lambda e: (-e[1], e[0].id)) for wave in plan.waves ]
+		plan.blocked = [ (pending[pkg_id], blocked[pkg_id]) for pkg_id in sorted(blocked) ]
+		plan.cyclic = [ pending[pkg_id] for pkg_id in sorted(planned) if count[pkg_id] > 0 ]
+
+		return plan
+
+	def find_cycles(self):
+		# Finds the dependency cycles preventing packages from being built.
+		# Only unmet dependencies of pending packages upon other pending
+		# packages are considered, so cycles among packages which are up
+		# to date don't count. Strongly connected components are found
+		# with an iterative form of Tarjan's algorithm. The back edges it
+		# finds within each component are the ones to break: with them
+		# removed the component is acyclic.
+		pending = self.pending()
+		providers = self.pending_providers(pending)
+
+		edges = {}
+		for p in pending.values():
+			out = {}
+			for kind, dep in p.typed_build_deps():
+				if dep.met(self._up_to_date):
+					continue
+				for pkg_id, ver in providers.get(dep.name, ()):
+					if dep.met({ dep.name: ver }):
+						out.setdefault(pkg_id, []).append((kind, dep.name))
+			edges[p.id] = out
+
+		index = {}
+		low = {}
+		stack = []
+		on_stack = set()
+		active = set()
+		back_edges = []
+		cycles = []
+
+		for root in sorted(edges):
+			if root in index:
+				continue
+
+			index[root] = low[root] = len(index)
+			stack.append(root)
+			on_stack.add(root)
+			active.add(root)
+			work = [ (root, iter(edges[root])) ]
+
+			while len(work) > 0:
+				v, it = work[-1]
+
+				for w in it:
+					if w not in index:
+						index[w] = low[w] = len(index)
+						stack.append(w)
+						on_stack.add(w)
+						active.add(w)
+						work.append((w, iter(edges[w])))
+						break
+
+					if w in on_stack:
+						low[v] = min(low[v], index[w])
+						if w in active:
+							back_edges.append((v, w))
+				else:
+					work.pop()
+					active.discard(v)
+
+					if len(work) > 0:
+						u = work[-1][0]
+						low[u] = min(low[u], low[v])
+
+					if low[v] != index[v]:
+						continue
+
+					members = []
+					while True:
+						w = stack.pop()
+						on_stack.discard(w)
+						members.append(w)
+						if w == v:
+							break
+
+					if len(members) > 1 or v in edges[v]:
+						cycles.append(set(members))
+
+		result = []
+		for members in cycles:
+			breaks = [ (pending[v], kind, name, pending[w])
+				   for v, w in back_edges if v in members and w in members
+				   for kind, name in edges[v][w] ]
+			result.append(([ pending[m] for m in sorted(members) ], breaks))
+
+		return sorted(result, key=lambda c: c[0][0].id)
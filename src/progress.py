@@ -0,0 +1,55 @@
+import threading
+import time
+
+from contextlib import contextmanager
+
+class Progress:
+	# Records the stages a long running task works through & how long each
+	# took, so that clients can follow along whilst it runs. Each stage is
+	# of some part of the task, such as a repo, so that several parts may
+	# go through the same stages.
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._stages = []
+
+	def record(self, part, name, started, seconds=None, error=None):
+		entry = {
+			"part": part,
+			"stage": name,
+			"started": started,
+			"seconds": seconds,
+			"error": error,
+		}
+
+		with self._lock:
+			self._stages.append(entry)
+
+		return entry
+
+	@contextmanager
+	def stage(self, part, name):
+		entry = self.record(part, name, time.time())
+
+		try:
+			yield
+		except Exception as ex:
+			entry["error"] = str(ex)
+			raise
+		finally:
+			with self._lock:
+				entry["seconds"] = time.time() - entry["started"]
+
+	def stages(self):
+		with self._lock:
+			return [ dict(s) for s in self._stages ]
+
+	@contextmanager
+	def track(progress, part, name):
+		# As Progress.stage, for callers which may not have been given
+		# anything to report progress to
+		if progress is None:
+			yield
+			return
+
+		with progress.stage(part, name):
+			yield
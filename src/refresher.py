@@ -0,0 +1,132 @@
+import collections
+import threading
+import time
+
+from config import Config
+from progress import Progress
+
+class Refresher:
+	# Runs refreshes in the background, one at a time. Requests made whilst
+	# a refresh is waiting to start join it, so however many arrive during
+	# a run only one more follows it. Refreshes are also started every
+	# Config.refresh_interval() seconds, unless one is already due.
+
+	# How many finished jobs are kept for clients to look at
+	_history = 16
+
+	# How often, in seconds, the scheduler checks whether we're exiting
+	_poll_interval = 0.5
+
+	class Job(Progress):
+		QUEUED = "queued"
+		RUNNING = "running"
+		DONE = "done"
+		FAILED = "failed"
+
+		def __init__(self, job_id, reason):
+			super().__init__()
+			self.id = job_id
+			self.reason = reason
+			self.requests = 0
+			self.state = Refresher.Job.QUEUED
+			self.error = None
+			self.queued = time.time()
+			self.started = None
+			self.finished = None
+
+		@property
+		def finished_running(self):
+			return self.state in ( Refresher.Job.DONE, Refresher.Job.FAILED )
+
+		def run(self, fn):
+			self.started = time.time()
+			self.state = Refresher.Job.RUNNING
+			print("Refresh job {0} started ({1})".format(self.id, self.reason))
+
+			try:
+				fn(self)
+				self.state = Refresher.Job.DONE
+			except Exception as ex:
+				self.error = str(ex)
+				self.state = Refresher.Job.FAILED
+
+			self.finished = time.time()
+			print("Refresh job {0} {1} in {2:.2f}s".format(
+				self.id, self.state, self.finished - self.started))
+
+		def to_json(self):
+			return {
+				"id": self.id,
+				"reason": self.reason,
+				"requests": self.requests,
+				"state": self.state,
+				"error": self.error,
+				"queued": self.queued,
+				"started": self.started,
+				"finished": self.finished,
+				"stages": self.stages(),
+			}
+
+	def __init__(self, daemon):
+		self._daemon = daemon
+		self._cond = threading.Condition()
+		self._jobs = collections.OrderedDict()
+		self._next_id = 1
+		self._queued = None
+		self._thread = None
+
+	def queue(self, reason):
+		# Returns the job that will carry out a refresh for reason, which
+		# is the one waiting to start if there is one
+		with self._cond:
+			job = self._queued
+			if job is None:
+				job = Refresher.Job(self._next_id, reason)
+				self._next_id += 1
+				self._jobs[job.id] = job
+				self._queued = job
+				self.expire()
+				self._cond.notify()
+
+			job.requests += 1
+			return job
+
+	def job(self, job_id):
+		with self._cond:
+			return self._jobs.get(job_id, None)
+
+	def expire(self):
+		finished = [ j.id for j in self._jobs.values() if j.finished_running ]
+		for job_id in finished[:max(0, len(finished) - Refresher._history)]:
+			del self._jobs[job_id]
+
+	def start(self):
+		self._thread = threading.Thread(target=self.run, daemon=True)
+		self._thread.start()
+
+	def join(self):
+		if self._thread is not None:
+			self._thread.join()
+
+	def run(self):
+		interval = Config.refresh_interval()
+		next_run = time.time() + interval if interval > 0 else None
+
+		while not self._daemon._exit:
+			with self._cond:
+				if self._queued is None:
+					self._cond.wait(Refresher._poll_interval)
+
+				if self._queued is None and next_run is not None and time.time() >= next_run:
+					self.queue("scheduled")
+
+				job = self._queued
+				self._queued = None
+
+			if job is None:
+				continue
+
+			if next_run is not None:
+				next_run = time.time() + interval
+
+			job.run(self._daemon.refresh)
@@ -1,44 +1,71 @@
+import sys
+import weakref
+
+from types import MappingProxyType
+
+from vercmp import VerCmp
+
+# Versions, dependencies & names recur across thousands of packages & every
+# architecture's graph, so each distinct one is only kept once. Objects in
+# these tables are never modified once created. The tables hold them weakly,
+# so entries go away with the last package using them.
+
 class PkgVersion:
-	def __init__(self, epoch=None, ver="0", rel=0):
+	__slots__ = ( "_epoch", "_ver", "_rel", "_ver_key", "_rel_key", "__weakref__" )
+
+	_interned = weakref.WeakValueDictionary()
+
+	def __init__(self, epoch=None, ver="0", rel=None):
 		self._epoch = epoch
-		self._ver = ver
-		self._rel = rel
+		self._ver = sys.intern(ver) if ver is not None else None
+		self._rel = sys.intern(rel) if rel is not None else None
 
-	def __eq__(self, other):
-		if self._epoch != other._epoch:
-			return False
-		if self._ver != other._ver:
-			return False
-		if self._rel != other._rel:
-			return False
-		return True
+		# parsed once here, as versions are compared far more often than
+		# they're created
+		self._ver_key = VerCmp.parse(ver)
+		self._rel_key = VerCmp.parse(rel) if rel is not None else None
 
-	def __gt__(self, other):
+	def compare(self, other):
+		# As pacman's vercmp: the release is only considered if both
+		# versions have one
 		sepoch = self._epoch if self._epoch is not None else 0
 		oepoch = other._epoch if other._epoch is not None else 0
-		if sepoch > oepoch:
-			return True
-		if sepoch < oepoch:
-			return False
+		if sepoch != oepoch:
+			return 1 if sepoch > oepoch else -1
 
-		if self._ver > other._ver:
-			return True
-		if self._ver < other._ver:
-			return False
+		ret = VerCmp.compare(self._ver_key, other._ver_key)
+		if ret != 0:
+			return ret
 
-		if self._rel > other._rel:
-			return True
-		if self._rel < other._rel:
-			return False
+		if self._rel_key is None or other._rel_key is None:
+			return 0
 
-		# equal
-		return False
+		return VerCmp.compare(self._rel_key, other._rel_key)
+
+	def __eq__(self, other):
+		if not isinstance(other, PkgVersion):
+			return NotImplemented
+		return self.compare(other) == 0
+
+	def __lt__(self, other):
+		return self.compare(other) < 0
+
+	def __le__(self, other):
+		return self.compare(other) <= 0
+
+	def __gt__(self, other):
+		return self.compare(other) > 0
 
 	def __ge__(self, other):
-		return self == other or self > other
+		return self.compare(other) >= 0
 
 	def __hash__(self):
-		return hash((self._epoch, self._ver, self._rel))
+		# Versions differing only in release may compare equal, so the
+		# release can't be part of the hash
+		return hash((self._epoch if self._epoch is not None else 0, self._ver_key))
+
+	def __reduce__(self):
+		return (PkgVersion.intern, (self._epoch, self._ver, self._rel))
 
 	def __str__(self):
 		s = self._ver
@@ -47,7 +74,7 @@ class PkgVersion:
 			s = "{0}:{1}".format(self._epoch, s)
 
 		if self._rel is not None:
-			s = "{0}-{1:g}".format(s, self._rel)
+			s = "{0}-{1}".format(s, self._rel)
 
 		return s
 
@@ -68,24 +95,45 @@ class PkgVersion:
 		ver = s
 		rel = None
 
-		if ":" in ver:
-			(epoch, _dummy, ver) = ver.partition(":")
-			epoch = int(epoch)
+		( head, sep, tail ) = ver.partition(":")
+		if sep != "" and head.isdigit():
+			epoch = int(head)
+			ver = tail
 
 		if "-" in ver:
-			(ver, _dummy, rel) = ver.partition("-")
-			rel = float(rel)
+			(ver, _dummy, rel) = ver.rpartition("-")
+
+		return PkgVersion.intern(epoch, ver, rel)
 
-		return PkgVersion(epoch, ver, rel)
+	def intern(epoch, ver, rel):
+		key = (epoch, ver, rel)
+		v = PkgVersion._interned.get(key, None)
+		if v is None:
+			v = PkgVersion(epoch, ver, rel)
+			PkgVersion._interned[key] = v
+		return v
 
 class PkgDep:
+	__slots__ = ( "name", "op", "_ver", "__weakref__" )
+
 	NO_VERSION = 0
 	EQUAL = 1
-	LESSER = 2,
-	GREATER = 3,
+	LESSER = 2
+	GREATER = 3
 	LESSER_EQUAL = 4
 	GREATER_EQUAL = 5
 
+	_op_strs = {
+		NO_VERSION: "",
+		EQUAL: "=",
+		LESSER: "<",
+		GREATER: ">",
+		LESSER_EQUAL: "<=",
+		GREATER_EQUAL: ">=",
+	}
+
+	_interned = weakref.WeakValueDictionary()
+
 	def __init__(self, str_dep):
 		ver = None
 
@@ -108,9 +156,30 @@ class PkgDep:
 			self.name = str_dep
 			self.op = PkgDep.NO_VERSION
 
+		self.name = sys.intern(self.name)
 		self._ver = PkgVersion.parse(ver) if ver is not None else None
 
+	def intern(str_dep):
+		dep = PkgDep._interned.get(str_dep, None)
+		if dep is None:
+			dep = PkgDep(str_dep)
+			PkgDep._interned[str_dep] = dep
+		return dep
+
+	def intern_all(str_deps):
+		return frozenset([ PkgDep.intern(d) for d in str_deps ])
+
+	def __reduce__(self):
+		return (PkgDep.intern, (str(self),))
+
+	def __str__(self):
+		if self._ver is None:
+			return self.name
+		return "{0}{1}{2}".format(self.name, PkgDep._op_strs[self.op], self._ver)
+
 	def __eq__(self, other):
+		if not isinstance(other, PkgDep):
+			return NotImplemented
 		if self.name != other.name:
 			return False
 		if self.op != other.op:
@@ -149,13 +218,17 @@ class PkgDep:
 		raise Exception("Unhandled op {0}".format(self.op))
 
 class BinPkg:
+	__slots__ = ( "_deps", "_desc", "_groups", "_name", "_optdeps", "_provides", "_src", "_ver" )
+
+	_no_provides = MappingProxyType({})
+
 	def __init__(self, src, name, ver, desc=""):
-		self._deps = set()
+		self._deps = frozenset()
 		self._desc = desc
-		self._groups = set()
-		self._name = name
-		self._optdeps = set()
-		self._provides = {}
+		self._groups = frozenset()
+		self._name = sys.intern(name)
+		self._optdeps = frozenset()
+		self._provides = None
 		self._src = src
 		self._ver = ver
 
@@ -181,6 +254,8 @@ class BinPkg:
 
 	@property
 	def provides(self):
+		if self._provides is None:
+			return BinPkg._no_provides
 		return self._provides
 
 	@property
@@ -192,10 +267,12 @@ class BinPkg:
 		return self._ver
 
 class SrcPkg:
+	__slots__ = ( "_checkdeps", "_makedeps", "_name", "_pkgs", "_repo", "_ver" )
+
 	def __init__(self, repo, name, ver):
-		self._checkdeps = set()
-		self._makedeps = set()
-		self._name = name
+		self._checkdeps = frozenset()
+		self._makedeps = frozenset()
+		self._name = sys.intern(name)
 		self._pkgs = {}
 		self._repo = repo
 		self._ver = ver
@@ -231,20 +308,95 @@ class SrcPkg:
 	def get_sourceball(self):
 		return self._repo.get_sourceball(self._name, self._ver)
 
+	def signature(self):
+		# Everything about the package that the graph looks at, used to
+		# tell whether a re-read package really changed
+		return (self._ver, self.excluded,
+			self._makedeps, self._checkdeps,
+			frozenset((b.name, b.version, b.desc, b.groups,
+				   b.depends, frozenset(b.provides.items()))
+				  for b in self.binaries))
+
 class Repo:
 	def __init__(self, name):
 		self._name = name
 		self._pkgs = {}
 
+		# The changes of refreshes which the graphs haven't taken on yet.
+		# A refresh moves the repo on whether or not the graphs are then
+		# updated, so these are handed out again until they have been.
+		self._unapplied = RepoChanges()
+
 	@property
 	def name(self):
 		return self._name
 
+	@property
+	def label(self):
+		return self._name
+
 	@property
 	def packages(self, want_dict=False):
 		if want_dict:
 			return self._pkgs
 		return self._pkgs.values()
 
-	def refresh(self):
+	def downloads(self):
+		return []
+
+	def fetch(self, progress=None):
+		pass
+
+	def refresh(self, progress=None):
 		raise Exception()
+
+	def unapplied(self, changes):
+		# Adds the changes of a refresh to any still to be applied,
+		# returning them all
+		self._unapplied = self._unapplied.merge(changes)
+		return self._unapplied
+
+	def applied(self):
+		# The graphs have taken on everything returned by unapplied().
+		# Refreshes & their acknowledgement happen one at a time, so
+		# nothing can have been added since.
+		self._unapplied = RepoChanges()
+
+class RepoChanges:
+	# The names of the source packages added to, removed from or modified
+	# within a repo by a refresh
+	def __init__(self, added=(), removed=(), changed=()):
+		self._added = set(added)
+		self._removed = set(removed)
+		self._changed = set(changed)
+
+	def __bool__(self):
+		return len(self._added) + len(self._removed) + len(self._changed) > 0
+
+	def __str__(self):
+		return "{0} added, {1} removed, {2} changed".format(
+			len(self._added), len(self._removed), len(self._changed))
+
+	@property
+	def added(self):
+		return self._added
+
+	@property
+	def removed(self):
+		return self._removed
+
+	@property
+	def changed(self):
+		return self._changed
+
+	@property
+	def names(self):
+		return self._added | self._removed | self._changed
+
+	def merge(self, other):
+		# The changes of this refresh followed by those of other. Where
+		# both touch a package, other says how.
+		names = other.names
+		return RepoChanges(added=(self._added - names) | other.added,
+				   removed=(self._removed - names) | other.removed,
+				   changed=(self._changed - names) | other.changed)
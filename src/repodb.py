@@ -0,0 +1,318 @@
+import base64
+import gzip
+import hashlib
+import os
+import tarfile
+import time
+import zlib
+
+from binaryrepo import BinaryRepo
+
+class RepoDB:
+	# Writes a repo's sync DB (<name>.db.tar.gz) & files DB
+	# (<name>.files.tar.gz) just as repo-add does, without running it.
+	# Entries are kept in memory once the DBs have been read, so adding
+	# packages only reads those packages. Each DB is then written whole to
+	# a temporary file & renamed into place. Should the DBs be changed by
+	# anything else, such as a manual repo-add, they're read again.
+
+	# .PKGINFO keys which may be given more than once
+	_pkginfo_lists = ( "group", "license", "replaces", "conflict", "provides",
+			   "depend", "optdepend", "makedepend", "checkdepend" )
+
+	# The fields of a desc file in the order repo-add writes them, along
+	# with the .PKGINFO key or property of the package file each is from
+	_desc_fields = [
+		( "FILENAME", "filename" ),
+		( "NAME", "pkgname" ),
+		( "BASE", "pkgbase" ),
+		( "VERSION", "pkgver" ),
+		( "DESC", "pkgdesc" ),
+		( "GROUPS", "group" ),
+		( "CSIZE", "csize" ),
+		( "ISIZE", "size" ),
+		( "MD5SUM", "md5sum" ),
+		( "SHA256SUM", "sha256sum" ),
+		( "PGPSIG", "pgpsig" ),
+		( "URL", "url" ),
+		( "LICENSE", "license" ),
+		( "ARCH", "arch" ),
+		( "BUILDDATE", "builddate" ),
+		( "PACKAGER", "packager" ),
+		( "REPLACES", "replaces" ),
+		( "CONFLICTS", "conflict" ),
+		( "PROVIDES", "provides" ),
+		( "DEPENDS", "depend" ),
+		( "OPTDEPENDS", "optdepend" ),
+		( "MAKEDEPENDS", "makedepend" ),
+		( "CHECKDEPENDS", "checkdepend" ),
+	]
+
+	# repo-add refuses signatures larger than this
+	_max_sig_size = 16384
+
+	class Entry:
+		# A package's entry in the DBs. members holds the (file name,
+		# content) pairs of its directory in the sync DB, & files the
+		# zlib compressed content of its "files" file in the files DB.
+		__slots__ = ( "name", "dir", "members", "files" )
+
+		def __init__(self, name, dir_name, members, files=None):
+			self.name = name
+			self.dir = dir_name
+			self.members = members
+			self.files = files
+
+	class HashingReader:
+		# Wraps a file, hashing whatever is read from it
+		def __init__(self, fp):
+			self._fp = fp
+			self.md5 = hashlib.md5()
+			self.sha256 = hashlib.sha256()
+			self.size = 0
+
+		def read(self, n=-1):
+			data = self._fp.read(n)
+			self.md5.update(data)
+			self.sha256.update(data)
+			self.size += len(data)
+			return data
+
+		def drain(self):
+			while len(self.read(1 << 20)) > 0:
+				pass
+
+	def __init__(self, pkg_dir, name):
+		self._db = os.path.join(pkg_dir, "{0}.db.tar.gz".format(name))
+		self._files = os.path.join(pkg_dir, "{0}.files.tar.gz".format(name))
+		self._entries = None
+		self._stamp = None
+
+	def stamp(self):
+		stamp = []
+		for path in ( self._db, self._files ):
+			try:
+				st = os.stat(path)
+				stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+			except FileNotFoundError:
+				stamp.append(None)
+		return tuple(stamp)
+
+	def load(self):
+		stamp = self.stamp()
+		by_dir = {}
+
+		if os.path.exists(self._db):
+			for path, data in BinaryRepo.read_tar(self._db):
+				( dir_name, _dummy, file_name ) = path.partition("/")
+				by_dir.setdefault(dir_name, []).append((file_name, data))
+
+		entries = {}
+		for dir_name, members in by_dir.items():
+			fields = {}
+			for file_name, data in members:
+				if file_name in ( "desc", "depends" ):
+					BinaryRepo.BinPkg.parse_fields(data, fields)
+			if not "name" in fields:
+				raise Exception("No name for {0} in {1}".format(dir_name, self._db))
+			entries[fields["name"][0]] = RepoDB.Entry(fields["name"][0], dir_name, members)
+
+		if os.path.exists(self._files):
+			dirs = dict([ (e.dir, e) for e in entries.values() ])
+			for path, data in BinaryRepo.read_tar(self._files):
+				( dir_name, _dummy, file_name ) = path.partition("/")
+				if file_name == "files" and dir_name in dirs:
+					dirs[dir_name].files = zlib.compress(data)
+
+		self._entries = entries
+		self._stamp = stamp
+
+	def add(self, paths):
+		# Adds packages to the DBs, replacing any others of the same names
+		# as repo-add does, then writes them out
+		if self._entries is None or self.stamp() != self._stamp:
+			self.load()
+
+		entries = dict(self._entries)
+		for path in paths:
+			entry = RepoDB.read_package(path)
+			entries[entry.name] = entry
+
+		self.write(self._files, entries, True)
+		self.write(self._db, entries, False)
+
+		self._entries = entries
+		self._stamp = self.stamp()
+
+	def read_package(path):
+		# Reads a package's .PKGINFO & file list, hashing the package in
+		# the same pass
+		with open(path, "rb") as fp:
+			reader = RepoDB.HashingReader(fp)
+			pkginfo = None
+			files = set()
+
+			for name, data in BinaryRepo.read_tar(reader, all_members=True, only={ ".PKGINFO" }):
+				if name == ".PKGINFO":
+					pkginfo = data
+				elif not name.startswith("."):
+					files.add(name)
+
+			reader.drain()
+
+		if pkginfo is None:
+			raise Exception("No .PKGINFO in {0}".format(path))
+
+		info = RepoDB.parse_pkginfo(pkginfo)
+		if not "pkgname" in info or not "pkgver" in info:
+			raise Exception("Incomplete .PKGINFO in {0}".format(path))
+
+		info["filename"] = os.path.basename(path)
+		info["csize"] = str(reader.size)
+		info["md5sum"] = reader.md5.hexdigest()
+		info["sha256sum"] = reader.sha256.hexdigest()
+
+		# As repo-add, the signature is the .sig beside the package, where
+		# DestRepo.add_packages places the one uploaded with it
+		pgpsig = RepoDB.read_signature("{0}.sig".format(path))
+		if pgpsig is not None:
+			info["pgpsig"] = pgpsig
+
+		desc = "".join([ RepoDB.format_entry(field, info.get(key, None))
+				 for field, key in RepoDB._desc_fields ])
+		file_list = "%FILES%\n" + "".join([ "{0}\n".format(f) for f in sorted(files) ])
+
+		return RepoDB.Entry(info["pkgname"],
+				    "{0}-{1}".format(info["pkgname"], info["pkgver"]),
+				    [ ("desc", desc.encode("utf-8")) ],
+				    zlib.compress(file_list.encode("utf-8")))
+
+	def parse_pkginfo(data):
+		info = {}
+
+		for line in data.decode("utf-8").split("\n"):
+			if line.startswith("#"):
+				continue
+
+			( key, sep, value ) = line.partition(" = ")
+			if sep == "":
+				continue
+
+			if key in RepoDB._pkginfo_lists:
+				info.setdefault(key, []).append(value)
+			else:
+				info[key] = value
+
+		return info
+
+	def read_signature(path):
+		# The base64 encoded detached signature of a package, if it has one
+		try:
+			with open(path, "rb") as fp:
+				sig = fp.read(RepoDB._max_sig_size + 1)
+		except FileNotFoundError:
+			return None
+
+		if b"BEGIN PGP SIGNATURE" in sig:
+			raise Exception("Cannot use armored signatures for packages: {0}".format(path))
+		if len(sig) > RepoDB._max_sig_size:
+			raise Exception("Invalid package signature file '{0}'".format(path))
+
+		return base64.b64encode(sig).decode("utf-8")
+
+	def format_entry(field, value):
+		# As repo-add, fields are left out if empty
+		values = value if isinstance(value, list) else [ value ]
+		if len(values) == 0 or values[0] is None or values[0] == "":
+			return ""
+
+		return "%{0}%\n{1}\n\n".format(field, "\n".join(values))
+
+	def tar_member(name, data, mtime):
+		# A directory if data is None, else a file. Headers are built
+		# directly, as tarfile is slow to make thousands of them, with only
+		# names too long for a plain ustar header left to tarfile.
+		directory = data is None
+		size = 0 if directory else len(data)
+		bname = name.encode("utf-8")
+
+		if len(bname) <= 100:
+			header = b"".join([
+				bname.ljust(100, b"\0"),
+				b"0000755\0" if directory else b"0000644\0",
+				b"0000000\0",
+				b"0000000\0",
+				b"%011o\0" % size,
+				b"%011o\0" % mtime,
+				b" " * 8,
+				b"5" if directory else b"0",
+				b"\0" * 100,
+				b"ustar\x0000",
+				b"root".ljust(32, b"\0"),
+				b"root".ljust(32, b"\0"),
+				b"\0" * 183,
+			])
+			header = header[:148] + b"%06o\0 " % sum(header) + header[156:]
+		else:
+			info = tarfile.TarInfo(name)
+			info.type = tarfile.DIRTYPE if directory else tarfile.REGTYPE
+			info.mode = 0o755 if directory else 0o644
+			info.size = size
+			info.mtime = mtime
+			info.uname = info.gname = "root"
+			header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+		if directory:
+			return header
+		return header + data + b"\0" * (-size % tarfile.BLOCKSIZE)
+
+	def write(self, path, entries, with_files):
+		# Writes a new DB beside path & renames it into place, keeping the
+		# previous one as .old, then points the <name>.db or <name>.files
+		# symlink at it, as repo-add does
+		tmp = os.path.join(os.path.dirname(path),
+			".{0}.{1}.tmp".format(os.path.basename(path), os.getpid()))
+		mtime = int(time.time())
+		written = 0
+
+		try:
+			with open(tmp, "wb") as raw:
+				with gzip.GzipFile(filename="", mode="wb", fileobj=raw,
+						   compresslevel=6, mtime=mtime) as gz:
+					for e in sorted(entries.values(), key=lambda e: e.dir):
+						members = list(e.members)
+						if with_files and e.files is not None:
+							members.append(("files", zlib.decompress(e.files)))
+
+						chunk = [ RepoDB.tar_member("{0}/".format(e.dir), None, mtime) ]
+						for file_name, data in members:
+							chunk.append(RepoDB.tar_member("{0}/{1}".format(e.dir, file_name), data, mtime))
+
+						chunk = b"".join(chunk)
+						gz.write(chunk)
+						written += len(chunk)
+
+					end = 2 * tarfile.BLOCKSIZE
+					end += -(written + end) % tarfile.RECORDSIZE
+					gz.write(b"\0" * end)
+
+				raw.flush()
+				os.fsync(raw.fileno())
+
+			old = "{0}.old".format(path)
+			if os.path.exists(path):
+				if os.path.lexists(old):
+					os.unlink(old)
+				os.link(path, old)
+
+			os.replace(tmp, path)
+		finally:
+			if os.path.lexists(tmp):
+				os.unlink(tmp)
+
+		link = path[:-len(".tar.gz")]
+		target = os.path.basename(path)
+		if not os.path.islink(link) or os.readlink(link) != target:
+			tmp_link = "{0}.{1}.tmp".format(link, os.getpid())
+			os.symlink(target, tmp_link)
+			os.replace(tmp_link, link)
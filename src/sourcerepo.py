@@ -1,78 +1,324 @@
+import hashlib
 import json
 import os
+import sqlite3
 import subprocess
+import sys
 
-from sh import bash
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from config import Config
+from fastparser import FastParser
 from repo import BinPkg
 from repo import PkgDep
 from repo import PkgVersion
 from repo import SrcPkg
 from repo import Repo
-from utils import slugify
+from repo import RepoChanges
 
 class SourceRepo(Repo):
 	_parse_script = os.path.join(
 		os.path.dirname(os.path.realpath(__file__)),
 		"spkg-parse.sh")
+	_parser_version = None
+	_excluded = "excluded"
 
 	def __init__(self, name):
 		Repo.__init__(self, name)
+		self._dirs = {}
 
-	def read_sources(self):
-		print("Reading {0}".format(self._repo))
+	def read_sources(self, dirs=None):
+		# Reads the packages in the given top-level directories of the
+		# checkout, or in all of them if dirs is None, and returns the
+		# resulting RepoChanges
+		full = dirs is None
+		if full:
+			print("Reading {0}".format(self._repo))
+			dirs = set(os.listdir(self._repo)) | set(self._dirs.keys())
+		else:
+			print("Reading {0} packages from {1}".format(len(dirs), self._repo))
 
-		self._pkgs = {}
-		parser_mtime = os.path.getmtime(SourceRepo._parse_script)
+		version = SourceRepo.parser_version()
+		found = {}
+		stale = {}
+		updates = []
 
-		for dir_name in os.listdir(self._repo):
-			if dir_name.startswith("."):
-				continue
+		with SourceRepo.Cache(self._cache) as cache:
+			entries = cache.load(None if full else dirs)
 
-			if os.path.exists(os.path.join(self._repo, dir_name, "EXCLUDE")):
-				spkg = SourceRepo.ExcludedSrcPkg(self, dir_name)
-				self._pkgs[spkg.name] = spkg
-				continue
+			for dir_name in sorted(dirs):
+				if dir_name.startswith("."):
+					continue
 
-			pkgbuild = os.path.join(self._repo, dir_name, "PKGBUILD")
-			if not os.path.exists(pkgbuild):
-				print("ERROR: {0} not found".format(pkgbuild))
-				continue
+				if not os.path.isdir(os.path.join(self._repo, dir_name)):
+					continue
 
-			cache = os.path.join(self._cache, slugify(dir_name))
+				if os.path.exists(os.path.join(self._repo, dir_name, "EXCLUDE")):
+					found[dir_name] = (SourceRepo._excluded, None)
+					continue
 
-			if not os.path.exists(cache):
-				reread = True
-			else:
-				cache_mtime = os.path.getmtime(cache)
+				pkgbuild = os.path.join(self._repo, dir_name, "PKGBUILD")
+				try:
+					st = os.stat(pkgbuild)
+				except FileNotFoundError:
+					print("ERROR: {0} not found".format(pkgbuild))
+					continue
+
+				entry = entries.get(dir_name, None)
+				if entry is not None and entry.version != version:
+					entry = None
+
+				# Only hash PKGBUILDs whose size or mtime has changed
+				if entry is not None and (entry.mtime != st.st_mtime_ns or
+							  entry.size != st.st_size):
+					digest = SourceRepo.hash_file(pkgbuild)
+					if digest != entry.hash:
+						entry = None
+					else:
+						entry = entry._replace(mtime=st.st_mtime_ns,
+								       size=st.st_size)
+						updates.append((dir_name, entry))
 
-				if cache_mtime < parser_mtime:
-					reread = True
-				elif cache_mtime < os.path.getmtime(pkgbuild):
-					reread = True
+				if entry is None:
+					stale[dir_name] = pkgbuild
+					continue
+
+				key = (entry.hash, version)
+				if self._dirs.get(dir_name, (None, None))[1] == key:
+					# already loaded & unchanged
+					found[dir_name] = (key, None)
 				else:
-					reread = False
+					found[dir_name] = (key, json.loads(entry.json))
+
+			for dir_name, pkg_json in SourceRepo.parse_pkgbuilds(stale):
+				if isinstance(pkg_json, Exception):
+					print("ERROR: failed to parse {0}: {1}".format(
+						stale[dir_name], pkg_json))
+					continue
+
+				st = os.stat(stale[dir_name])
+				entry = SourceRepo.Cache.Entry(
+					hash=SourceRepo.hash_file(stale[dir_name]),
+					mtime=st.st_mtime_ns,
+					size=st.st_size,
+					version=version,
+					json=json.dumps(pkg_json))
+				updates.append((dir_name, entry))
+
+				found[dir_name] = ((entry.hash, version), pkg_json)
+
+			cache.update(updates,
+				     removed=[ d for d in entries if d not in found ])
+
+		return self.apply_sources(dirs, found)
+
+	def apply_sources(self, dirs, found):
+		added = set()
+		removed = set()
+		updated = []
 
-			if reread:
-				pkg_json = SourceRepo.parse_pkgbuild(pkgbuild)
-				with open(cache, "w") as fp:
-					json.dump(pkg_json, fp)
+		for dir_name in sorted(dirs):
+			old_name, old_key = self._dirs.get(dir_name, (None, None))
+			key, pkg_json = found.get(dir_name, (None, None))
+
+			if key is not None and key == old_key:
+				continue
+
+			if old_name is not None:
+				del self._dirs[dir_name]
+				self._pkgs.pop(old_name, None)
+				removed.add(old_name)
+
+			if key is not None:
+				updated.append((dir_name, key, pkg_json))
+
+		# Only add packages once all replaced ones are gone, in case a
+		# package moved between directories
+		for dir_name, key, pkg_json in updated:
+			if key == SourceRepo._excluded:
+				spkg = SourceRepo.ExcludedSrcPkg(self, dir_name)
 			else:
-				with open(cache, "r") as fp:
-					pkg_json = json.load(fp)
+				spkg = SourceRepo.SrcPkg(self, pkg_json)
 
-			spkg = SourceRepo.SrcPkg(self, pkg_json)
 			self._pkgs[spkg.name] = spkg
+			self._dirs[dir_name] = (spkg.name, key)
+			added.add(spkg.name)
+
+		return RepoChanges(added=added - removed,
+				   removed=removed - added,
+				   changed=added & removed)
+
+	def hash_file(path):
+		with open(path, "rb") as fp:
+			return hashlib.sha256(fp.read()).hexdigest()
+
+	def parser_version():
+		# Cached results are only valid for the exact parser which
+		# produced them
+		if SourceRepo._parser_version is None:
+			digest = hashlib.sha256()
+			for path in (SourceRepo._parse_script, FastParser._path):
+				with open(path, "rb") as fp:
+					digest.update(fp.read())
+			SourceRepo._parser_version = "{0}-{1}".format(
+				FastParser.VERSION, digest.hexdigest())
+
+		return SourceRepo._parser_version
 
 	def parse_pkgbuild(pkgbuild):
-		json_str = bash(SourceRepo._parse_script, pkgbuild).stdout.decode('utf-8')
-		return json.loads(json_str)
+		with SourceRepo.Parser() as parser:
+			return parser.parse(pkgbuild)
+
+	def parse_pkgbuilds(pkgbuilds, fast=True):
+		# PKGBUILDs simple enough for FastParser are handled in-process.
+		# The rest are shared out between a bounded number of parser
+		# co-processes, each fed its whole share in one batch. Results are
+		# yielded in the order of the keys of pkgbuilds, with any exception
+		# raised by a parse yielded in place of its result.
+		if len(pkgbuilds) == 0:
+			return
+
+		results = {}
+		if fast:
+			for key, pkgbuild in pkgbuilds.items():
+				pkg_json = FastParser.parse_file(pkgbuild)
+				if pkg_json is not None:
+					results[key] = pkg_json
+
+		keys = [ k for k in pkgbuilds.keys() if k not in results ]
+		workers = min(Config.parse_workers(), len(keys))
+		batches = [ [ (k, pkgbuilds[k]) for k in keys[i::workers] ]
+			    for i in range(workers) ]
+
+		if workers > 0:
+			with ThreadPoolExecutor(max_workers=workers) as pool:
+				for batch_results in pool.map(SourceRepo.parse_batch, batches):
+					results.update(batch_results)
+
+		for key in pkgbuilds.keys():
+			yield key, results[key]
+
+	def parse_batch(batch):
+		results = []
+		parser = SourceRepo.Parser()
+
+		try:
+			for key, pkgbuild in batch:
+				try:
+					results.append((key, parser.parse(pkgbuild)))
+				except Exception as ex:
+					results.append((key, ex))
+		finally:
+			parser.close()
+
+		return results
 
 	def get_sourceball(self, name, ver):
 		return None
 
+	class Cache:
+		# All parsed packages of a source repo, stored in a single SQLite
+		# database keyed by package directory
+		Entry = namedtuple("Entry", [ "hash", "mtime", "size", "version", "json" ])
+
+		def __init__(self, path):
+			self._db = sqlite3.connect(path)
+			self._db.execute("""
+				CREATE TABLE IF NOT EXISTS packages (
+					dir TEXT PRIMARY KEY,
+					hash TEXT NOT NULL,
+					mtime INTEGER NOT NULL,
+					size INTEGER NOT NULL,
+					version TEXT NOT NULL,
+					json TEXT NOT NULL
+				)""")
+
+		def __enter__(self):
+			return self
+
+		def __exit__(self, exc_type, exc_value, traceback):
+			self._db.close()
+
+		def load(self, dirs=None):
+			query = "SELECT dir, hash, mtime, size, version, json FROM packages"
+
+			if dirs is None:
+				rows = self._db.execute(query)
+			else:
+				rows = []
+				dirs = list(dirs)
+				for i in range(0, len(dirs), 500):
+					chunk = dirs[i:i + 500]
+					rows.extend(self._db.execute(
+						"{0} WHERE dir IN ({1})".format(
+							query, ",".join("?" * len(chunk))),
+						chunk))
+
+			return { r[0]: SourceRepo.Cache.Entry(*r[1:]) for r in rows }
+
+		def update(self, entries, removed=[]):
+			with self._db:
+				self._db.executemany(
+					"INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?)",
+					[ (d,) + tuple(e) for d, e in entries ])
+				self._db.executemany(
+					"DELETE FROM packages WHERE dir = ?",
+					[ (d,) for d in removed ])
+
+	class Parser:
+		def __init__(self):
+			self._proc = None
+
+		def __enter__(self):
+			return self
+
+		def __exit__(self, exc_type, exc_value, traceback):
+			self.close()
+
+		def start(self):
+			self._proc = subprocess.Popen(["bash", SourceRepo._parse_script],
+						      stdin=subprocess.PIPE,
+						      stdout=subprocess.PIPE,
+						      universal_newlines=True)
+
+		def close(self):
+			if self._proc is None:
+				return
+
+			try:
+				self._proc.stdin.close()
+			except BrokenPipeError:
+				pass
+
+			self._proc.wait()
+			self._proc.stdout.close()
+			self._proc = None
+
+		def parse(self, pkgbuild):
+			# restart the co-process if a previous package killed it
+			if self._proc is not None and self._proc.poll() is not None:
+				self.close()
+			if self._proc is None:
+				self.start()
+
+			self._proc.stdin.write("{0}\n".format(pkgbuild))
+			self._proc.stdin.flush()
+
+			line = self._proc.stdout.readline()
+			if len(line) == 0:
+				self.close()
+				raise Exception("parser exited unexpectedly")
+
+			pkg_json = json.loads(line)
+			if "error" in pkg_json:
+				raise Exception(pkg_json["error"])
+
+			return pkg_json
+
 	class ExcludedSrcPkg(SrcPkg):
+		__slots__ = ()
+
 		def __init__(self, repo, name):
 			SrcPkg.__init__(self, repo, name, None)
 
@@ -81,6 +327,8 @@ class SourceRepo(Repo):
 			return True
 
 	class SrcPkg(SrcPkg):
+		__slots__ = ()
+
 		def __init__(self, repo, json):
 			if "base" in json:
 				name = json["base"]
@@ -88,22 +336,24 @@ class SourceRepo(Repo):
 				name = json["packages"][0]["name"]
 
 			ver = json["ver"]
-			rel = float(json["rel"])
+			rel = json["rel"]
 			epoch = int(json["epoch"]) if "epoch" in json else None
-			ver = PkgVersion(epoch, ver, rel)
+			ver = PkgVersion.intern(epoch, ver, rel)
 
 			super().__init__(repo, name, ver)
 
-			self._checkdeps = set([PkgDep(d) for d in json.get("checkdepends", [])])
-			self._makedeps = set([PkgDep(d) for d in json.get("makedepends", [])])
+			self._checkdeps = PkgDep.intern_all(json.get("checkdepends", []))
+			self._makedeps = PkgDep.intern_all(json.get("makedepends", []))
 
 			for pkg_json in json["packages"]:
 				bpkg = SourceRepo.BinPkg(self, pkg_json)
 				self._pkgs[bpkg.name] = bpkg
 
 	class BinPkg(BinPkg):
+		__slots__ = ()
+
 		def __init__(self, src, json):
 			super().__init__(src, json["name"], src.version)
-			self._deps = set([PkgDep(d) for d in json.get("depends", [])])
+			self._deps = PkgDep.intern_all(json.get("depends", []))
 			self._desc = json.get("desc", "")
-			self._groups = set(json.get("groups", []))
+			self._groups = frozenset([ sys.intern(g) for g in json.get("groups", []) ])
@@ -1,12 +1,23 @@
 #!/bin/sh
 
+# Usage: spkg-parse.sh [PKGBUILD]
+#
+# Prints the metadata of the given PKGBUILD as a single line of JSON. If no
+# PKGBUILD is given then paths are read from stdin, one per line, and a line
+# of JSON is written for each as soon as it has been parsed. All packages are
+# sourced by the same restricted bash, each in its own subshell. A package
+# which fails to parse produces { "error": "..." } in place of its metadata.
+
 set -eu
 set -o pipefail
 
 tmpDir="`mktemp -d`"
+parserPid=""
 
 cleanup()
 {
+    exec 3<&- 4>&-
+    [ -z "${parserPid}" ] || kill ${parserPid} 2>/dev/null || true
     rm -rf "${tmpDir}"
     trap - EXIT INT TERM
 }
@@ -18,26 +29,31 @@ die()
     exit 1
 }
 
-pkgBuild="$1"
-[ -e "${pkgBuild}" ] || die "PKGBUILD not found"
-
 outputName=`mktemp --tmpdir=/usr/bin -u XXXXXXXX`
 outputName=`basename ${outputName}`
 
 writeOutput=`mktemp --tmpdir=/usr/bin -u XXXXXXXX`
 writeOutput=`basename ${writeOutput}`
 
-touch ${tmpDir}/output
+requestName=`mktemp --tmpdir=/usr/bin -u XXXXXXXX`
+requestName=`basename ${requestName}`
+
+endMarker="@@end"
+timeout=60
+
+mkfifo ${tmpDir}/output ${tmpDir}/request
 mkdir -p ${tmpDir}/root/pkg/{src,pkg}
 
+# Keep both FIFOs open read-write so that neither side sees EOF between
+# packages and so that opening them from within proot never blocks
+exec 3<>${tmpDir}/output 4<>${tmpDir}/request
+
 cat >${tmpDir}/__write_output <<EOF
 #!/bin/sh
 cat <&0 >>/usr/bin/${outputName}
 EOF
 chmod +x ${tmpDir}/__write_output
 
-cp "${pkgBuild}" ${tmpDir}/root/pkg/PKGBUILD
-
 PATH="/usr/bin" `which proot` \
     -r "${tmpDir}/root" -w /pkg \
     -b /usr -b /etc -b /bin -b /lib -b /lib64 \
@@ -45,23 +61,12 @@ PATH="/usr/bin" `which proot` \
     -b /usr/bin/true:/usr/bin/install \
     -b /usr/bin/true:/usr/bin/mv \
     -b "${tmpDir}/output:/usr/bin/${outputName}" \
+    -b "${tmpDir}/request:/usr/bin/${requestName}" \
     -b "${tmpDir}/__write_output:/usr/bin/${writeOutput}" \
-    bash --restricted --noprofile --norc >/dev/null 2>&1 <<EOF
+    bash --restricted --noprofile --norc >/dev/null 2>&1 3<&- 4>&- <<EOF &
 export CARCH="mips32r2el"
 export CHOST="mipsel-unknown-linux-gnu"
 
-srcdir=\${PWD}/src
-depends=()
-makedepends=()
-checkdepends=()
-provides=()
-arch=()
-
-source PKGBUILD
-
-set -e
-set -o pipefail
-
 escape_json()
 {
   echo -n "\$@" | \
@@ -74,6 +79,20 @@ escape_json()
     sed 's|\\t|\\\\t|g'
 }
 
+while read -r __request; do
+(
+srcdir=\${PWD}/src
+depends=()
+makedepends=()
+checkdepends=()
+provides=()
+arch=()
+
+source PKGBUILD
+
+set -e
+set -o pipefail
+
 echo "{" | ${writeOutput}
 [ -z "\${pkgbase}" ] || echo "  \"base\": \"\${pkgbase}\"," | ${writeOutput}
 echo "  \"ver\": \"\${pkgver}\"," | ${writeOutput}
@@ -253,7 +272,52 @@ echo "  ]" | ${writeOutput}
 echo "}" | ${writeOutput}
 
 while kill -9 %% 2>/dev/null; do jobs > /dev/null; done
+) </dev/null
+echo "${endMarker} \$?" | ${writeOutput}
+done </usr/bin/${requestName}
 
 EOF
+parserPid=$!
+
+parse()
+{
+    local line status record=""
+
+    if [ ! -e "$1" ] || ! cp "$1" ${tmpDir}/root/pkg/PKGBUILD; then
+        echo "{ \"error\": \"PKGBUILD not found\" }"
+        return
+    fi
+
+    echo "$1" >&4
+
+    while true; do
+        IFS= read -r -t ${timeout} line <&3 || die "Timed out parsing $1"
+
+        case "${line}" in
+        "${endMarker} "*)
+            status="${line#${endMarker} }"
+            break
+            ;;
+        esac
+
+        record="${record}${line} "
+    done
+
+    if [ "${status}" = "0" ]; then
+        echo "${record}"
+    else
+        echo "{ \"error\": \"PKGBUILD exited with status ${status}\" }"
+    fi
+}
+
+if [ $# -gt 0 ]; then
+    parse "$1"
+else
+    while IFS= read -r pkgBuild; do
+        parse "${pkgBuild}"
+    done
+fi
 
-cat ${tmpDir}/output
+# Closing the request FIFO ends the parser loop
+exec 4>&-
+wait ${parserPid} || true
@@ -0,0 +1,74 @@
+from binaryrepo import BinaryRepo
+from download import Downloader
+from gitsourcerepo import GitSourceRepo
+from progress import Progress
+from repo import RepoChanges
+
+class Upstreams:
+	# The repos packages are built from, keyed by URL & shared between the
+	# graphs of every architecture. However many architectures use one, it
+	# is only downloaded, parsed & held in memory once.
+	def __init__(self):
+		self._repos = {}
+		self._downloader = Downloader()
+
+	@property
+	def repos(self):
+		return self._repos.values()
+
+	def get(self, name, cfg):
+		if "binary" in cfg:
+			key = ("binary", name, cfg["binary"])
+		elif "source-git" in cfg:
+			key = ("source-git", name, cfg["source-git"])
+		else:
+			raise Exception("unknown repo type: {0}".format(cfg))
+
+		repo = self._repos.get(key, None)
+		if repo is not None:
+			return repo
+
+		if key[0] == "binary":
+			repo = BinaryRepo(name, key[2])
+		else:
+			repo = GitSourceRepo(name, key[2])
+
+		self._repos[key] = repo
+		return repo
+
+	def fetch(self, progress=None):
+		# Downloads mirror files & pulls git checkouts ahead of refresh.
+		# Nothing read from the repos changes, so this needn't hold up
+		# anything else. Mirror files are all fetched at once so that the
+		# downloads overlap across repos.
+		downloads = [ (repo, d) for repo in self._repos.values() for d in repo.downloads() ]
+
+		with Progress.track(progress, "upstreams", "download"):
+			results = self._downloader.fetch_all([ d for repo, d in downloads ])
+
+		if progress is not None:
+			for ( repo, d ), r in zip(downloads, results):
+				progress.record(repo.label, "download", r.started, r.seconds,
+						str(r.error) if r.error is not None else None)
+
+		for repo in self._repos.values():
+			repo.fetch(progress)
+
+	def refresh(self, progress=None):
+		# Re-reads every upstream repo from what fetch() left, returning
+		# the RepoChanges of each along with any of earlier refreshes not
+		# yet applied
+		changes = {}
+		for repo in self._repos.values():
+			changes[repo] = repo.unapplied(repo.refresh(progress))
+
+		return changes
+
+	def applied(self):
+		# Called once the graphs have been updated with what refresh
+		# returned
+		for repo in self._repos.values():
+			repo.applied()
+
+	def changes_for(changes, repo):
+		return changes.get(repo, None) or RepoChanges()
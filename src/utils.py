@@ -1,6 +1,100 @@
+import errno
+import fcntl
+import os
 import re
+import shutil
 
 from unidecode import unidecode
 
 def slugify(s):
 	return re.sub(r'\W+', '-', unidecode(s).lower())
+
+# FICLONE from linux/fs.h
+_FICLONE = 0x40049409
+
+# Errors meaning a way of cloning a file isn't possible between two paths,
+# rather than that something is wrong with them
+_clone_unsupported = ( errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP,
+		       errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF )
+
+def clone_file(src, dst):
+	# Creates dst with the content of src as cheaply as possible: a hard
+	# link where both are on one filesystem, else a reflink, else a copy
+	# within the kernel, only copying through userspace if none of those
+	# work. dst must not already exist. Returns which was used.
+	try:
+		os.link(src, dst)
+		return "link"
+	except OSError as ex:
+		if ex.errno not in _clone_unsupported:
+			raise
+
+	with open(src, "rb") as fsrc:
+		fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+
+		try:
+			with open(fd, "wb") as fdst:
+				return _clone_data(fsrc, fdst)
+		except:
+			os.unlink(dst)
+			raise
+
+def _clone_data(fsrc, fdst):
+	try:
+		fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+		return "reflink"
+	except OSError as ex:
+		if ex.errno not in _clone_unsupported:
+			raise
+
+	if hasattr(os, "copy_file_range"):
+		size = os.fstat(fsrc.fileno()).st_size
+		copied = 0
+
+		try:
+			while copied < size:
+				n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+				if n == 0:
+					break
+				copied += n
+			if copied == size:
+				return "copy_file_range"
+		except OSError as ex:
+			if ex.errno not in _clone_unsupported:
+				raise
+
+		# start again from scratch
+		fsrc.seek(0)
+		fdst.seek(0)
+		fdst.truncate()
+
+	shutil.copyfileobj(fsrc, fdst, 1 << 20)
+	return "copy"
+
+def place_file(src, dst):
+	# Puts the content of src at dst, which must not already exist. It is
+	# cloned to a staging file beside dst, then linked into place, so that
+	# dst only ever appears complete & is never silently replaced.
+	stage = os.path.join(os.path.dirname(dst),
+		".{0}.{1}.part".format(os.path.basename(dst), os.getpid()))
+
+	if os.path.lexists(stage):
+		os.unlink(stage)
+
+	try:
+		method = clone_file(src, stage)
+
+		try:
+			os.link(stage, dst)
+		except OSError as ex:
+			if ex.errno not in _clone_unsupported:
+				raise
+			# no hard links here, so settle for checking beforehand
+			if os.path.lexists(dst):
+				raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+			os.rename(stage, dst)
+	finally:
+		if os.path.lexists(stage):
+			os.unlink(stage)
+
+	return method
@@ -0,0 +1,96 @@
+import re
+
+class VerCmp:
+	# A reimplementation of pacman's rpmvercmp. Strings are split once into
+	# segments, which can then be compared repeatedly without re-scanning.
+	# rpmvercmp isn't transitive for some odd combinations of separators,
+	# so there's no sort key which agrees with it everywhere & segments are
+	# compared pairwise instead.
+	_segment_re = re.compile(r"([^A-Za-z0-9]*)([0-9]+|[A-Za-z]+)")
+
+	def parse(s):
+		# Returns (segments, trailing) where each segment is a tuple of
+		# (separator length, is numeric, value) & trailing is whether s
+		# ends with separators. Numeric values are (length, digits) with
+		# leading zeroes stripped, which orders them as numbers.
+		segments = []
+		end = 0
+
+		for m in VerCmp._segment_re.finditer(s):
+			sep, value = m.groups()
+			if value[0].isdigit():
+				value = value.lstrip("0")
+				segments.append((len(sep), True, (len(value), value)))
+			else:
+				segments.append((len(sep), False, value))
+			end = m.end()
+
+		return (tuple(segments), end < len(s))
+
+	def compare(a, b):
+		# Compares two parsed strings, returning -1, 0 or 1. Segment tuples
+		# order just as rpmvercmp orders segments, so only running off the
+		# end of one string needs handling specially.
+		if a == b:
+			return 0
+
+		( sa, ta ) = a
+		( sb, tb ) = b
+
+		if len(sa) == len(sb):
+			if sa != sb:
+				return -1 if sa < sb else 1
+			return 1 if ta else -1
+
+		n = min(len(sa), len(sb))
+		( pa, pb ) = ( sa[:n], sb[:n] )
+		if pa != pb:
+			return -1 if pa < pb else 1
+
+		if len(sa) < len(sb):
+			return -VerCmp.compare_tail(sb[n], ta)
+		return VerCmp.compare_tail(sa[n], tb)
+
+	def compare_tail(seg, trailing):
+		# One string has a further segment seg where the other has only
+		# trailing separators, or nothing. An alphabetic segment sorts
+		# before the end of a string (1.0a < 1.0), anything else after it.
+		# A string that simply ended also sorts before any separator.
+		if seg[1]:
+			return 1
+		if trailing or seg[0] == 0:
+			return -1
+		return 1
+
+	def vercmp(a, b):
+		# Compares full [epoch:]version[-rel] strings as pacman does
+		if a == b:
+			return 0
+
+		( ea, va, ra ) = VerCmp.split(a)
+		( eb, vb, rb ) = VerCmp.split(b)
+
+		ret = VerCmp.compare(VerCmp.parse(ea), VerCmp.parse(eb))
+		if ret == 0:
+			ret = VerCmp.compare(VerCmp.parse(va), VerCmp.parse(vb))
+		if ret == 0 and ra is not None and rb is not None:
+			ret = VerCmp.compare(VerCmp.parse(ra), VerCmp.parse(rb))
+
+		return ret
+
+	def split(s):
+		# Splits [epoch:]version[-rel], as pacman's parseEVR
+		epoch = "0"
+		rel = None
+
+		( head, sep, tail ) = s.partition(":")
+		if sep != "" and head.isdigit():
+			epoch = head
+			s = tail
+		elif sep != "" and head == "":
+			s = tail
+
+		if "-" in s:
+			( s, _dummy, rel ) = s.rpartition("-")
+
+		return (epoch, s, rel)
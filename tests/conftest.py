@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from config import Config
+
+@pytest.fixture
+def config(tmp_path):
+	# Each test gets its own settings, with a cache in its own directory
+	saved = Config._json
+	Config._json = { "cache_dir": str(tmp_path / "cache") }
+	yield Config._json
+	Config._json = saved
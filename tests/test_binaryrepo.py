@@ -0,0 +1,54 @@
+import io
+import os
+import tarfile
+import threading
+
+from binaryrepo import BinaryRepo
+
+def write_abs(path, name, pkgs, content=b"pkgname=foo\n"):
+	with tarfile.open(path, "w:gz") as tar:
+		for pkg in pkgs:
+			info = tarfile.TarInfo("{0}/{1}/PKGBUILD".format(name, pkg))
+			info.size = len(content)
+			tar.addfile(info, io.BytesIO(content))
+
+def test_get_sourceball(config):
+	repo = BinaryRepo("core", "http://mirror.invalid/core")
+	write_abs(repo._cache_src, "core", [ "foo", "bar" ])
+	repo.index_sources()
+
+	with tarfile.open(fileobj=repo.get_sourceball("foo", None)) as tar:
+		assert tar.getnames() == [ "PKGBUILD" ]
+
+	for name in ( "..", ".", ".stamp", "", "foo/..", "../src", "/etc/passwd", "missing" ):
+		assert repo.get_sourceball(name, None) is None
+
+def test_reindex_is_atomic(config):
+	repo = BinaryRepo("core", "http://mirror.invalid/core")
+	write_abs(repo._cache_src, "core", [ "foo" ])
+	repo.index_sources()
+
+	missing = []
+	done = threading.Event()
+
+	def read():
+		while not done.is_set():
+			if repo.get_sourceball("foo", None) is None:
+				missing.append(True)
+
+	reader = threading.Thread(target=read)
+	reader.start()
+
+	try:
+		for i in range(20):
+			write_abs(repo._cache_src, "core", [ "foo" ], "pkgrel={0}\n".format(i).encode())
+			repo.index_sources()
+	finally:
+		done.set()
+		reader.join()
+
+	assert missing == []
+	assert os.path.islink(repo._cache_src_dir)
+
+	cache_dir = os.path.dirname(repo._cache_src_dir)
+	assert len([ e for e in os.listdir(cache_dir) if e.startswith("src.d.") ]) == 1
@@ -0,0 +1,101 @@
+import socket
+import threading
+import time
+
+import pytest
+import zmq
+
+from daemon import Daemon
+
+class Slow:
+	# Stands in for a command, taking a while to reply & optionally
+	# asking the daemon to exit first
+	def __init__(self, seconds, stop=False):
+		self._seconds = seconds
+		self._stop = stop
+
+	def __call__(self, daemon):
+		self._daemon = daemon
+		return self
+
+	def invoke(self, pg, req):
+		if self._stop:
+			self._daemon._exit = True
+		time.sleep(self._seconds)
+		return { "slept": self._seconds }
+
+@pytest.fixture
+def daemon(config):
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		port = s.getsockname()[1]
+
+	config.update({
+		"architectures": [ "x86_64" ],
+		"repos": [],
+		"rpc_addr": "tcp://127.0.0.1:{0}".format(port),
+		"rpc_workers": 3,
+	})
+
+	d = Daemon()
+	thread = threading.Thread(target=d.run, daemon=True)
+	thread.start()
+
+	yield d, thread
+
+	d._exit = True
+	thread.join(10)
+
+def request(ctx, addr, cmd, replies, timeout=5000):
+	s = ctx.socket(zmq.REQ)
+	s.setsockopt(zmq.LINGER, 0)
+	s.connect(addr)
+	s.send_json({ "cmd": cmd, "arch": "x86_64" })
+	if s.poll(timeout):
+		replies[cmd] = s.recv_json()
+	s.close()
+
+def start(ctx, addr, cmd, replies, timeout=5000):
+	t = threading.Thread(target=request, args=(ctx, addr, cmd, replies, timeout))
+	t.start()
+	return t
+
+def test_stop_reply_after_other_replies(daemon, config):
+	( d, thread ) = daemon
+	d._cmd_lookup["slow"] = Slow(0.3)
+	d._cmd_lookup["stop"] = Slow(1.2, stop=True)
+
+	ctx = zmq.Context()
+	replies = {}
+
+	# the slow request replies after the daemon starts exiting but before
+	# the stop request does, which itself takes longer than a poll
+	slow = start(ctx, config["rpc_addr"], "slow", replies)
+	time.sleep(0.1)
+	stop = start(ctx, config["rpc_addr"], "stop", replies)
+	slow.join()
+	stop.join()
+
+	thread.join(10)
+	assert not thread.is_alive()
+	assert replies == { "slow": { "slept": 0.3 }, "stop": { "slept": 1.2 } }
+	ctx.destroy(linger=0)
+
+def test_no_requests_taken_once_exiting(daemon, config):
+	( d, thread ) = daemon
+	d._cmd_lookup["slow"] = Slow(0.2)
+	d._cmd_lookup["stop"] = Slow(1.0, stop=True)
+
+	ctx = zmq.Context()
+	replies = {}
+
+	stop = start(ctx, config["rpc_addr"], "stop", replies)
+	time.sleep(0.3)
+	late = start(ctx, config["rpc_addr"], "slow", replies, timeout=2000)
+	stop.join()
+	late.join()
+
+	thread.join(10)
+	assert not thread.is_alive()
+	assert replies == { "stop": { "slept": 1.0 } }
+	ctx.destroy(linger=0)
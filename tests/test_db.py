@@ -0,0 +1,343 @@
+import threading
+import time
+
+import pytest
+
+from db import DB
+
+@pytest.fixture
+def memory(config):
+	config.update({
+		"db_backend": "memory",
+		"db_memory_latency": 0,
+		"db_pool_size": 2,
+		"db_write_retries": 2,
+		"db_write_timeout": 0.1,
+	})
+	( DB._backend, DB._writer ) = ( None, None )
+	yield config
+	( DB._backend, DB._writer ) = ( None, None )
+
+class Conn:
+	def __init__(self):
+		self.open = True
+
+	def close(self):
+		self.open = False
+
+def test_pool_reuse():
+	opened = []
+	pool = DB.Pool(lambda: opened.append(Conn()) or opened[-1], lambda c: c.open, 2, 30)
+
+	for i in range(3):
+		with pool.connection() as conn:
+			assert conn is opened[0]
+
+	assert pool.metrics() == { "idle": 1, "opened": 1, "reused": 2, "discarded": 0 }
+
+	pool.close()
+	assert not opened[0].open
+	assert pool.metrics()["idle"] == 0
+
+def test_pool_checks_stale_connections():
+	opened = []
+	healthy = [ True ]
+	checked = []
+
+	def check(conn):
+		checked.append(conn)
+		return healthy[0]
+
+	pool = DB.Pool(lambda: opened.append(Conn()) or opened[-1], check, 2, 0.05)
+
+	with pool.connection() as conn:
+		pass
+	with pool.connection() as conn:
+		pass
+	assert checked == []
+
+	# idle past check_after, & still good
+	time.sleep(0.1)
+	with pool.connection() as conn:
+		assert conn is opened[0]
+	assert checked == [ opened[0] ]
+
+	# idle past check_after, & gone bad
+	healthy[0] = False
+	time.sleep(0.1)
+	with pool.connection() as conn:
+		assert conn is opened[1]
+
+	assert not opened[0].open
+	assert pool.metrics() == { "idle": 1, "opened": 2, "reused": 2, "discarded": 1 }
+
+def test_pool_discards_on_error():
+	opened = []
+	pool = DB.Pool(lambda: opened.append(Conn()) or opened[-1], lambda c: c.open, 2, 30)
+
+	with pytest.raises(ValueError):
+		with pool.connection() as conn:
+			raise ValueError()
+
+	assert not opened[0].open
+	assert pool.metrics() == { "idle": 0, "opened": 1, "reused": 0, "discarded": 1 }
+
+def test_pool_size():
+	lock = threading.Lock()
+	busy = [ 0, 0 ]
+	pool = DB.Pool(Conn, lambda c: c.open, 2, 30)
+
+	def use():
+		for i in range(20):
+			with pool.connection() as conn:
+				with lock:
+					busy[0] += 1
+					busy[1] = max(busy[0], busy[1])
+				time.sleep(0.001)
+				with lock:
+					busy[0] -= 1
+
+	threads = [ threading.Thread(target=use) for i in range(8) ]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+
+	assert busy[1] <= 2
+	assert pool.metrics()["opened"] <= 2
+
+def test_async_inserts(memory):
+	memory["db_write_timeout"] = 10
+	done = threading.Event()
+	errors = []
+
+	def read():
+		while not done.is_set():
+			try:
+				builds = DB.recent_builds(10)
+				times = [ b["time_upload"] for b in builds ]
+				assert times == sorted(times, reverse=True)
+				assert len(set([ b["pkg"] for b in builds ])) == len(builds)
+			except Exception as ex:
+				errors.append(ex)
+
+	readers = [ threading.Thread(target=read) for i in range(8) ]
+	for r in readers:
+		r.start()
+
+	try:
+		for i in range(3000):
+			DB.insert_build_async(DB.new_build("x86_64", "core/p{0}".format(i % 50), "1.0-{0}".format(i), "done"))
+		assert DB.writer().flush(30)
+	finally:
+		done.set()
+		for r in readers:
+			r.join()
+
+	assert errors == []
+	assert DB.writer().metrics() == { "buffered": 0, "written": 3000, "retries": 0, "dropped": 0 }
+	assert DB.metrics()["pool"]["opened"] <= 2
+
+	latest = DB.recent_builds(100)
+	assert len(latest) == 50
+	assert latest[0]["version"] == "1.0-2999"
+	assert len(DB.recent_builds(5000, show_all=True)) == 3000
+
+class Failing:
+	# A backend whose inserts fail a number of times before succeeding
+	def __init__(self, failures):
+		self.failures = failures
+		self.written = []
+
+	def insert_builds(self, builds):
+		if self.failures > 0:
+			self.failures -= 1
+			raise Exception("unavailable")
+		self.written.extend(builds)
+
+def test_writer_retries(memory):
+	backend = Failing(2)
+	writer = DB.Writer(backend)
+
+	writer.put({ "pkg": "core/foo" })
+	assert writer.flush(5)
+
+	assert backend.written == [ { "pkg": "core/foo" } ]
+	assert writer.metrics() == { "buffered": 0, "written": 1, "retries": 2, "dropped": 0 }
+
+def test_writer_drops(memory):
+	backend = Failing(3)
+	writer = DB.Writer(backend)
+
+	writer.put({ "pkg": "core/foo" })
+	assert writer.flush(5)
+
+	assert backend.written == []
+	assert writer.metrics() == { "buffered": 0, "written": 0, "retries": 2, "dropped": 1 }
+
+class Blocked:
+	def __init__(self):
+		self.release = threading.Event()
+
+	def insert_builds(self, builds):
+		self.release.wait()
+
+def test_writer_buffer_full(memory):
+	memory["db_write_buffer"] = 2
+	backend = Blocked()
+	writer = DB.Writer(backend)
+
+	# one being written, two buffered
+	writer.put({ "pkg": "core/a" })
+	time.sleep(0.1)
+	writer.put({ "pkg": "core/b" })
+	writer.put({ "pkg": "core/c" })
+
+	with pytest.raises(Exception, match="DB write buffer full"):
+		writer.put({ "pkg": "core/d" })
+
+	backend.release.set()
+	assert writer.flush(5)
+	assert writer.metrics()["written"] == 3
+
+def test_close_leaves_pool_whilst_writing(memory):
+	backend = DB.backend()
+	closed = []
+	backend.pool.close = lambda: closed.append(True)
+
+	blocked = Blocked()
+	insert = backend.insert_builds
+	backend.insert_builds = lambda builds: blocked.insert_builds(builds) or insert(builds)
+
+	DB.insert_build_async(DB.new_build("x86_64", "core/foo", "1.0-1", "done"))
+	DB.close(timeout=0.1)
+	assert closed == []
+
+	blocked.release.set()
+	DB.close(timeout=5)
+	assert closed == [ True ]
+	assert len(DB.recent_builds()) == 1
+
+class FakeRethink:
+	# Just enough of the RethinkDB query language for
+	# RethinkBackend.prepare, with builds & latest builds kept in dicts.
+	# fail names a step to raise at, as if the daemon died there.
+	class Query:
+		def __init__(self, fake, step, fn):
+			self._fake = fake
+			self._step = step
+			self._fn = fn
+
+		def run(self, conn):
+			if self._fake.fail == self._step:
+				self._fake.fail = None
+				raise Exception("died at {0}".format(self._step))
+			self._fake.steps.append(self._step)
+			return self._fn()
+
+	class Table:
+		def __init__(self, fake, name):
+			self._fake = fake
+			self._name = name
+
+		def query(self, step, fn):
+			return FakeRethink.Query(self._fake, "{0} {1}".format(step, self._name), fn)
+
+		def index_list(self):
+			return self.query("index_list", lambda: list(self._fake.indexes[self._name]))
+
+		def index_create(self, index):
+			return self.query("index_create", lambda: self._fake.indexes[self._name].add(index))
+
+		def index_wait(self, index):
+			def wait():
+				if not index in self._fake.indexes[self._name]:
+					raise Exception("no index {0} on {1}".format(index, self._name))
+			return self.query("index_wait", wait)
+
+		def get(self, key):
+			return self.query("get", lambda: self._fake.docs[self._name].get(key, None))
+
+		def insert(self, docs, conflict=None):
+			def insert():
+				table = self._fake.docs[self._name]
+				if docs == "latest":
+					rows = self._fake.latest()
+				else:
+					rows = [ docs ] if isinstance(docs, dict) else docs
+				for doc in rows:
+					key = doc["pkg"] if self._name == "latest_builds" else doc["id"]
+					old = table.get(key, None)
+					if old is None or conflict == "replace" or doc["time_upload"] > old["time_upload"]:
+						table[key] = doc
+				return { "errors": 0 }
+			return self.query("insert", insert)
+
+		def group(self, key):
+			return self
+
+		def max(self, key):
+			return self
+
+		def ungroup(self):
+			return { "reduction": "latest" }
+
+	def __init__(self, builds):
+		self.docs = { "builds": dict([ (b["id"], b) for b in builds ]) }
+		self.indexes = { "builds": set() }
+		self.fail = None
+		self.steps = []
+
+	def latest(self):
+		latest = {}
+		for b in self.docs["builds"].values():
+			if not b["pkg"] in latest or b["time_upload"] > latest[b["pkg"]]["time_upload"]:
+				latest[b["pkg"]] = b
+		return latest.values()
+
+	def table_list(self):
+		return FakeRethink.Query(self, "table_list", lambda: list(self.docs))
+
+	def table_create(self, name, primary_key):
+		def create():
+			self.docs[name] = {}
+			self.indexes[name] = set()
+		return FakeRethink.Query(self, "table_create {0}".format(name), create)
+
+	def table(self, name):
+		return FakeRethink.Table(self, name)
+
+	def now(self):
+		return 0
+
+@pytest.mark.parametrize("fail", [
+	"table_create latest_builds",
+	"table_create meta",
+	"index_create latest_builds",
+	"index_wait latest_builds",
+	"insert latest_builds",
+	"insert meta",
+])
+def test_prepare_resumes(config, monkeypatch, fail):
+	import db
+
+	builds = [ { "id": str(i), "pkg": "core/p{0}".format(i % 3), "time_upload": i } for i in range(10) ]
+	fake = FakeRethink(builds)
+	monkeypatch.setattr(db, "r", fake)
+
+	fake.fail = fail
+	with pytest.raises(Exception, match="died at"):
+		DB.RethinkBackend().prepare(None)
+
+	# a new daemon finishes the job
+	DB.RethinkBackend().prepare(None)
+	assert fake.indexes["builds"] == { "time_upload" }
+	assert fake.indexes["latest_builds"] == { "time_upload" }
+	assert sorted([ (b["pkg"], b["time_upload"]) for b in fake.docs["latest_builds"].values() ]) == [
+		("core/p0", 9), ("core/p1", 7), ("core/p2", 8) ]
+	assert "latest_builds" in fake.docs["meta"]
+
+	# & once done, nothing is redone
+	fake.steps = []
+	DB.RethinkBackend().prepare(None)
+	assert not [ s for s in fake.steps if s.split()[0] in ( "table_create", "index_create", "insert" ) ]
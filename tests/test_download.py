@@ -0,0 +1,239 @@
+import http.server
+import json
+import os
+import threading
+import time
+
+from email.utils import formatdate
+from email.utils import parsedate_to_datetime
+
+import pytest
+
+from download import Downloader
+
+class StandIn:
+	# A mirror serving files from memory, with the conditional & range
+	# requests Downloader relies upon. It can be made to ignore ranges,
+	# fail outright, or drop the connection part way through a file.
+	def __init__(self):
+		self.files = {}
+		self.requests = []
+		self.ignore_range = False
+		self.status = None
+		self.cut_after = None
+
+		stand_in = self
+
+		class Handler(http.server.BaseHTTPRequestHandler):
+			def log_message(self, *args):
+				pass
+
+			def do_GET(self):
+				stand_in.handle(self)
+
+		self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self._thread = threading.Thread(target=self._server.serve_forever,
+						kwargs={ "poll_interval": 0.05 }, daemon=True)
+		self._thread.start()
+
+	def url(self, path):
+		return "http://127.0.0.1:{0}/{1}".format(self._server.server_port, path)
+
+	def put(self, path, data, etag):
+		self.files["/" + path] = ( data, etag, time.time() - 60 )
+
+	def close(self):
+		self._server.shutdown()
+		self._server.server_close()
+
+	def handle(self, req):
+		self.requests.append(dict(req.headers))
+
+		if self.status is not None:
+			req.send_response(self.status)
+			req.send_header("Content-Length", "0")
+			req.end_headers()
+			return
+
+		( data, etag, mtime ) = self.files[req.path]
+		ims = req.headers.get("If-Modified-Since")
+		if ims is not None and parsedate_to_datetime(ims).timestamp() >= int(mtime):
+			req.send_response(304)
+			req.end_headers()
+			return
+
+		status = 200
+		body = data
+		rng = req.headers.get("Range")
+		if rng is not None and not self.ignore_range and req.headers.get("If-Range") == etag:
+			offset = int(rng[len("bytes="):-1])
+			if offset >= len(data):
+				req.send_response(416)
+				req.send_header("Content-Length", "0")
+				req.end_headers()
+				return
+			status = 206
+			body = data[offset:]
+
+		req.send_response(status)
+		req.send_header("ETag", etag)
+		req.send_header("Last-Modified", formatdate(timeval=mtime, usegmt=True))
+		req.send_header("Content-Length", str(len(body)))
+		if status == 206:
+			req.send_header("Content-Range", "bytes {0}-{1}/{2}".format(
+				len(data) - len(body), len(data) - 1, len(data)))
+		req.end_headers()
+
+		if self.cut_after is not None:
+			req.wfile.write(body[:self.cut_after])
+			req.wfile.flush()
+			req.close_connection = True
+			return
+
+		req.wfile.write(body)
+
+@pytest.fixture
+def mirror():
+	stand_in = StandIn()
+	yield stand_in
+	stand_in.close()
+
+@pytest.fixture
+def downloader():
+	return Downloader(workers=4, timeout=5)
+
+def read(path):
+	with open(path, "rb") as fp:
+		return fp.read()
+
+def partial(path, data, validator):
+	with open("{0}.part".format(path), "wb") as fp:
+		fp.write(data)
+	with open("{0}.part.meta".format(path), "w") as fp:
+		json.dump({ "validator": validator }, fp)
+
+def leftovers(path):
+	return [ p for p in ( "{0}.part".format(path), "{0}.part.meta".format(path) ) if os.path.exists(p) ]
+
+DATA = bytes(range(256)) * 4096
+
+def test_fresh_fetch(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	path = str(tmp_path / "db")
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert result.modified and not result.resumed
+	assert result.bytes == len(DATA)
+	assert read(path) == DATA
+	assert leftovers(path) == []
+
+def test_fetch_all(mirror, downloader, tmp_path):
+	for i in range(6):
+		mirror.put("f{0}".format(i), DATA[i:], '"v{0}"'.format(i))
+	files = [ (mirror.url("f{0}".format(i)), str(tmp_path / str(i))) for i in range(6) ]
+
+	results = downloader.fetch_all(files)
+
+	assert [ r.filename for r in results ] == [ f for u, f in files ]
+	assert all([ r.error is None for r in results ])
+	assert all([ read(f) == DATA[i:] for i, ( u, f ) in enumerate(files) ])
+
+def test_not_modified(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	path = str(tmp_path / "db")
+	downloader.fetch(mirror.url("core.db"), path)
+	mtime = os.stat(path).st_mtime_ns
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert not result.modified
+	assert "If-Modified-Since" in mirror.requests[-1]
+	assert os.stat(path).st_mtime_ns == mtime
+	assert read(path) == DATA
+
+def test_resume(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	path = str(tmp_path / "db")
+	partial(path, DATA[:1000], '"v1"')
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert result.resumed
+	assert result.bytes == len(DATA) - 1000
+	assert mirror.requests[-1]["Range"] == "bytes=1000-"
+	assert mirror.requests[-1]["If-Range"] == '"v1"'
+	assert read(path) == DATA
+	assert leftovers(path) == []
+
+def test_resume_changed_file(mirror, downloader, tmp_path):
+	# If-Range doesn't match, so the server sends the whole new file
+	new = DATA[::-1]
+	mirror.put("core.db", new, '"v2"')
+	path = str(tmp_path / "db")
+	partial(path, DATA[:1000], '"v1"')
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert not result.resumed
+	assert read(path) == new
+	assert leftovers(path) == []
+
+def test_resume_range_ignored(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	mirror.ignore_range = True
+	path = str(tmp_path / "db")
+	partial(path, DATA[:1000], '"v1"')
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert not result.resumed
+	assert result.bytes == len(DATA)
+	assert read(path) == DATA
+
+def test_interrupted_then_resumed(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	mirror.cut_after = 300000
+	path = str(tmp_path / "db")
+
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	# only the partial file exists until the download completes
+	assert result.error is not None
+	assert not os.path.exists(path)
+	done = read("{0}.part".format(path))
+	assert len(done) > 0 and DATA.startswith(done)
+
+	mirror.cut_after = None
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is None
+	assert result.resumed
+	assert result.bytes == len(DATA) - len(done)
+	assert read(path) == DATA
+	assert leftovers(path) == []
+
+def test_failure_keeps_cached_copy(mirror, downloader, tmp_path):
+	mirror.put("core.db", DATA, '"v1"')
+	path = str(tmp_path / "db")
+	downloader.fetch(mirror.url("core.db"), path)
+
+	mirror.put("core.db", DATA[::-1], '"v2"')
+	mirror.files["/core.db"] = mirror.files["/core.db"][:2] + ( time.time() + 60, )
+	mirror.cut_after = 5000
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is not None
+	assert read(path) == DATA
+
+	mirror.cut_after = None
+	mirror.status = 500
+	result = downloader.fetch(mirror.url("core.db"), path)
+
+	assert result.error is not None
+	assert read(path) == DATA
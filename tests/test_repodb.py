@@ -0,0 +1,222 @@
+import base64
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+
+import pytest
+
+from binaryrepo import BinaryRepo
+from repodb import RepoDB
+
+PKGINFO = """# Generated by makepkg 6.0.2
+# using fakeroot version 1.30
+pkgname = {name}
+pkgbase = {name}-base
+pkgver = {ver}
+pkgdesc = The {name} = tool
+url = https://example.org/{name}
+builddate = 1700000000
+packager = Someone <someone@example.org>
+size = 12345
+arch = x86_64
+license = GPL
+license = MIT
+group = base-devel
+provides = lib{name}.so=1-64
+depend = glibc
+depend = zlib>=1.2
+optdepend = python: scripts
+makedepend = cmake
+checkdepend = check
+"""
+
+def make_package(directory, name, ver, members=(), install=False):
+	# A package laid out as makepkg leaves it: metadata dot files first,
+	# then the package's own files, directories & links
+	path = os.path.join(directory, "{0}-{1}-x86_64.pkg.tar.xz".format(name, ver))
+
+	with tarfile.open(path, "w:xz", format=tarfile.GNU_FORMAT) as tar:
+		def add(member, data=None, kind=tarfile.REGTYPE, link=""):
+			info = tarfile.TarInfo(member)
+			info.type = kind
+			info.linkname = link
+			info.mtime = 1700000000
+			if data is None:
+				tar.addfile(info)
+			else:
+				info.size = len(data)
+				tar.addfile(info, io.BytesIO(data))
+
+		add(".BUILDINFO", b"format = 2\n")
+		add(".MTREE", b"#mtree\n")
+		add(".PKGINFO", PKGINFO.format(name=name, ver=ver).encode("utf-8"))
+		if install:
+			add(".INSTALL", b"post_install() { true; }\n")
+
+		for member in members:
+			if member.endswith("/"):
+				add(member, kind=tarfile.DIRTYPE)
+			elif "->" in member:
+				( member, _dummy, target ) = member.partition(" -> ")
+				add(member, kind=tarfile.SYMTYPE, link=target)
+			else:
+				add(member, "{0}\n".format(member).encode("utf-8"))
+
+	return path
+
+@pytest.fixture
+def packages(tmp_path):
+	# One signed, one with dot files & empty directories, & a later
+	# version of the first
+	src = tmp_path / "src"
+	src.mkdir()
+
+	signed = make_package(str(src), "foo", "1:2.0-3",
+		[ "usr/", "usr/bin/", "usr/bin/foo" ])
+	with open(signed + ".sig", "wb") as fp:
+		fp.write(b"\x89\x01\x33binary signature")
+
+	dotted = make_package(str(src), "bar", "0.1-1", [
+		"etc/", "etc/bar/", "etc/bar/.hidden", "etc/bar/bar.conf",
+		"usr/", "usr/share/", "usr/share/bar/", "usr/share/bar/empty/",
+		"usr/lib/", "usr/lib/libbar.so -> libbar.so.1", "usr/lib/libbar.so.1",
+	], install=True)
+
+	upgraded = make_package(str(src), "foo", "1:2.1-1",
+		[ "usr/", "usr/bin/", "usr/bin/foo", "usr/bin/foo2" ])
+
+	return { "signed": signed, "dotted": dotted, "upgraded": upgraded }
+
+def read_db(path):
+	return dict(BinaryRepo.read_tar(path))
+
+def test_desc(tmp_path, packages):
+	repo = tmp_path / "repo"
+	repo.mkdir()
+	RepoDB(str(repo), "core").add([ packages["signed"] ])
+
+	with open(packages["signed"], "rb") as fp:
+		data = fp.read()
+
+	# the fields & their order as repo-add writes them
+	expected = (
+		"%FILENAME%\nfoo-1:2.0-3-x86_64.pkg.tar.xz\n\n"
+		"%NAME%\nfoo\n\n"
+		"%BASE%\nfoo-base\n\n"
+		"%VERSION%\n1:2.0-3\n\n"
+		"%DESC%\nThe foo = tool\n\n"
+		"%GROUPS%\nbase-devel\n\n"
+		"%CSIZE%\n{0}\n\n"
+		"%ISIZE%\n12345\n\n"
+		"%MD5SUM%\n{1}\n\n"
+		"%SHA256SUM%\n{2}\n\n"
+		"%PGPSIG%\n{3}\n\n"
+		"%URL%\nhttps://example.org/foo\n\n"
+		"%LICENSE%\nGPL\nMIT\n\n"
+		"%ARCH%\nx86_64\n\n"
+		"%BUILDDATE%\n1700000000\n\n"
+		"%PACKAGER%\nSomeone <someone@example.org>\n\n"
+		"%PROVIDES%\nlibfoo.so=1-64\n\n"
+		"%DEPENDS%\nglibc\nzlib>=1.2\n\n"
+		"%OPTDEPENDS%\npython: scripts\n\n"
+		"%MAKEDEPENDS%\ncmake\n\n"
+		"%CHECKDEPENDS%\ncheck\n\n").format(
+			len(data), hashlib.md5(data).hexdigest(), hashlib.sha256(data).hexdigest(),
+			base64.b64encode(b"\x89\x01\x33binary signature").decode("utf-8"))
+
+	db = read_db(str(repo / "core.db.tar.gz"))
+	assert list(db) == [ "foo-1:2.0-3/desc" ]
+	assert db["foo-1:2.0-3/desc"].decode("utf-8") == expected
+
+	files = read_db(str(repo / "core.files.tar.gz"))
+	assert sorted(files) == [ "foo-1:2.0-3/desc", "foo-1:2.0-3/files" ]
+	assert files["foo-1:2.0-3/desc"] == db["foo-1:2.0-3/desc"]
+
+def test_files(tmp_path, packages):
+	repo = tmp_path / "repo"
+	repo.mkdir()
+	RepoDB(str(repo), "core").add([ packages["dotted"] ])
+
+	# only the package's own metadata is left out, not dot files within
+	# it, & directories keep their trailing slash
+	files = read_db(str(repo / "core.files.tar.gz"))
+	assert files["bar-0.1-1/files"].decode("utf-8") == (
+		"%FILES%\n"
+		"etc/\netc/bar/\netc/bar/.hidden\netc/bar/bar.conf\n"
+		"usr/\nusr/lib/\nusr/lib/libbar.so\nusr/lib/libbar.so.1\n"
+		"usr/share/\nusr/share/bar/\nusr/share/bar/empty/\n")
+
+	# unsigned, so no %PGPSIG%
+	assert not "%PGPSIG%" in read_db(str(repo / "core.db.tar.gz"))["bar-0.1-1/desc"].decode("utf-8")
+
+@pytest.mark.skipif(shutil.which("bsdtar") is None, reason="bsdtar not installed")
+def test_files_as_listed_by_bsdtar(tmp_path, packages):
+	# repo-add lists a package's files with exactly this
+	repo = tmp_path / "repo"
+	repo.mkdir()
+	RepoDB(str(repo), "core").add([ packages["dotted"], packages["signed"] ])
+	files = read_db(str(repo / "core.files.tar.gz"))
+
+	for path, entry in ( ( packages["dotted"], "bar-0.1-1" ), ( packages["signed"], "foo-1:2.0-3" ) ):
+		listed = subprocess.run("bsdtar --exclude='^.*' -tf '{0}' | LC_ALL=C sort -u".format(path),
+					shell=True, check=True, stdout=subprocess.PIPE).stdout
+		assert files["{0}/files".format(entry)] == b"%FILES%\n" + listed
+
+def test_replace(tmp_path, packages):
+	repo = tmp_path / "repo"
+	repo.mkdir()
+	db = RepoDB(str(repo), "core")
+	db.add([ packages["signed"], packages["dotted"] ])
+	db.add([ packages["upgraded"] ])
+
+	assert sorted(read_db(str(repo / "core.db.tar.gz"))) == [ "bar-0.1-1/desc", "foo-1:2.1-1/desc" ]
+	assert os.readlink(str(repo / "core.db")) == "core.db.tar.gz"
+	assert os.readlink(str(repo / "core.files")) == "core.files.tar.gz"
+	assert sorted(read_db(str(repo / "core.db.tar.gz.old"))) == [ "bar-0.1-1/desc", "foo-1:2.0-3/desc" ]
+
+	# a new RepoDB reads what the last one wrote
+	RepoDB(str(repo), "core").add([ packages["signed"] ])
+	assert sorted(read_db(str(repo / "core.files.tar.gz"))) == [
+		"bar-0.1-1/desc", "bar-0.1-1/files", "foo-1:2.0-3/desc", "foo-1:2.0-3/files" ]
+
+def test_bad_signatures(tmp_path, packages):
+	repo = tmp_path / "repo"
+	repo.mkdir()
+	db = RepoDB(str(repo), "core")
+
+	with open(packages["dotted"] + ".sig", "wb") as fp:
+		fp.write(b"-----BEGIN PGP SIGNATURE-----\n")
+	with pytest.raises(Exception, match="armored"):
+		db.add([ packages["dotted"] ])
+
+	with open(packages["dotted"] + ".sig", "wb") as fp:
+		fp.write(b"\x89" * (RepoDB._max_sig_size + 1))
+	with pytest.raises(Exception, match="Invalid package signature"):
+		db.add([ packages["dotted"] ])
+
+@pytest.mark.skipif(shutil.which("repo-add") is None, reason="repo-add not installed")
+def test_matches_repo_add(tmp_path, packages):
+	# Adds the same packages to new repos with both repo-add & RepoDB,
+	# then compares the content of each entry, as tar headers &
+	# compression differ
+	theirs = tmp_path / "repo-add"
+	ours = tmp_path / "repodb"
+	theirs.mkdir()
+	ours.mkdir()
+
+	db = RepoDB(str(ours), "test")
+	for name in ( "signed", "dotted", "upgraded" ):
+		subprocess.run([ "repo-add", "-q", str(theirs / "test.db.tar.gz"), packages[name] ], check=True)
+		db.add([ packages[name] ])
+
+	for name in ( "test.db", "test.files" ):
+		assert os.readlink(str(ours / name)) == os.readlink(str(theirs / name))
+
+		a = read_db(str(theirs / "{0}.tar.gz".format(name)))
+		b = read_db(str(ours / "{0}.tar.gz".format(name)))
+		assert sorted(b) == sorted(a)
+		for member in a:
+			assert b[member].decode("utf-8") == a[member].decode("utf-8"), member
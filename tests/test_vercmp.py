@@ -0,0 +1,67 @@
+import pytest
+
+from repo import PkgVersion
+from vercmp import VerCmp
+
+# From pacman's test/util/vercmptest.sh
+cases = [
+	( "1.5.0", "1.5.0", 0 ),
+	( "1.5.1", "1.5.0", 1 ),
+	( "1.5.1", "1.5", 1 ),
+	( "1.5.0-1", "1.5.0-1", 0 ),
+	( "1.5.0-1", "1.5.0-2", -1 ),
+	( "1.5.0-1", "1.5.1-1", -1 ),
+	( "1.5.0-2", "1.5.1-1", -1 ),
+	( "1.5-1", "1.5.1-1", -1 ),
+	( "1.5-2", "1.5.1-1", -1 ),
+	( "1.5-2", "1.5.1-2", -1 ),
+	( "1.5", "1.5-1", 0 ),
+	( "1.5-1", "1.5", 0 ),
+	( "1.1-1", "1.1", 0 ),
+	( "1.0-1", "1.1", -1 ),
+	( "1.1-1", "1.0", 1 ),
+	( "1.5b-1", "1.5-1", -1 ),
+	( "1.5b", "1.5", -1 ),
+	( "1.5b-1", "1.5", -1 ),
+	( "1.5b", "1.5.1", -1 ),
+	( "1.0a", "1.0alpha", -1 ),
+	( "1.0alpha", "1.0b", -1 ),
+	( "1.0b", "1.0beta", -1 ),
+	( "1.0beta", "1.0rc", -1 ),
+	( "1.0rc", "1.0", -1 ),
+	( "1.5.a", "1.5", 1 ),
+	( "1.5.b", "1.5.a", 1 ),
+	( "1.5.1", "1.5.b", 1 ),
+	( "1.5.b-1", "1.5.b", 0 ),
+	( "1.5-1", "1.5.b", -1 ),
+	( "2.0", "2_0", 0 ),
+	( "2.0_a", "2_0.a", 0 ),
+	( "2.0a", "2.0.a", -1 ),
+	( "2___a", "2_a", 1 ),
+	( "0:1.0", "0:1.0", 0 ),
+	( "0:1.0", "0:1.1", -1 ),
+	( "1:1.0", "0:1.0", 1 ),
+	( "1:1.0", "0:1.1", 1 ),
+	( "1:1.0", "2:1.1", -1 ),
+	( "1:1.0", "0:1.0-1", 1 ),
+	( "1:1.0-1", "0:1.1-1", 1 ),
+	( "0:1.0", "1.0", 0 ),
+	( "0:1.1", "1.0", 1 ),
+	( "0:1.1", "1.1", 0 ),
+	( "1.0", "0:1.1", -1 ),
+	( "1:1.0", "1.0", 1 ),
+	( "1:1.1", "1.1", 1 ),
+	( "1.1", "1:1.1", -1 ),
+]
+
+@pytest.mark.parametrize("a,b,want", cases)
+def test_vercmp(a, b, want):
+	assert VerCmp.vercmp(a, b) == want
+	assert VerCmp.vercmp(b, a) == -want
+
+@pytest.mark.parametrize("a,b,want", cases)
+def test_pkgversion(a, b, want):
+	# PkgVersion compares through the same parsed keys
+	( x, y ) = ( PkgVersion.parse(a), PkgVersion.parse(b) )
+	assert x.compare(y) == want
+	assert y.compare(x) == -want